@@ -1,22 +1,34 @@
+import asyncio
+import functools
+import io
 import logging
+import math
+import re
 import sqlite3
-import hashlib
 import qrcode
 import os
 import sys
 import threading
-import json
+import time
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import ORJSONResponse
 import uvicorn
 from telegram import (
     Update,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
 )
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -27,6 +39,12 @@ from telegram.ext import (
     ContextTypes,
 )
 
+# uvloop быстрее стандартного event loop, но есть не везде (например, нет под Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # ================== КОНФИГУРАЦИЯ ДЛЯ RENDER ==================
 # Добавляем текущую директорию в путь Python
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -72,8 +90,17 @@ LOYALTY_SETTINGS = {
     'birthday_bonus': 500,  # Бонус на день рождения
 }
 
+# Настройки как отдельные константы, проценты для текстов посчитаны заранее
+POINTS_PER_PURCHASE = LOYALTY_SETTINGS['points_per_purchase']
+DISCOUNT_PER_POINT = LOYALTY_SETTINGS['discount_per_point']
+MAX_DISCOUNT = LOYALTY_SETTINGS['max_discount']
+WELCOME_BONUS = LOYALTY_SETTINGS['welcome_bonus']
+BIRTHDAY_BONUS = LOYALTY_SETTINGS['birthday_bonus']
+POINTS_PER_PURCHASE_PCT = POINTS_PER_PURCHASE * 100
+DISCOUNT_PER_POINT_PCT = DISCOUNT_PER_POINT * 100
+
 # Админы по ID Telegram аккаунтов
-ADMINS = [YOUR_TELEGRAM_ID]
+ADMINS = frozenset([YOUR_TELEGRAM_ID])
 
 # Состояния для ConversationHandler
 PHONE, NAME, GENDER = range(3)
@@ -87,19 +114,297 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ================== ТЕКСТЫ СООБЩЕНИЙ ==================
+# Тексты зависят только от настроек модуля и собираются один раз при импорте
+
+RULES_MESSAGE = (
+    "📋 *Правила программы лояльности:*\n\n"
+    f"🎁 *Начисление баллов:*\n"
+    f"• За каждый рубль покупки: {POINTS_PER_PURCHASE_PCT}% от суммы\n"
+    f"• Бонус за регистрацию: {WELCOME_BONUS} баллов\n\n"
+    f"💰 *Использование баллов:*\n"
+    f"• 1 балл = {DISCOUNT_PER_POINT_PCT}% скидки\n"
+    f"• Максимальная скидка: {MAX_DISCOUNT}%\n"
+    f"• Баллы не имеют срока действия\n\n"
+    f"📱 *Как использовать:*\n"
+    f"1. Покажите QR код на кассе для начисления баллов\n"
+    f"2. Добавляйте покупки через кнопку '➕ Добавить покупку'\n"
+    f"3. Копите баллы\n"
+    f"4. Используйте баллы через кнопку '🎁 Использовать баллы'"
+)
+
+HELP_MESSAGE = (
+    "🆘 *Помощь по боту:*\n\n"
+    "📋 *Основные функции:*\n"
+    "• 💰 Мой баланс - просмотр баланса баллов\n"
+    "• 📊 История операций - последние транзакции\n"
+    "• ➕ Добавить покупку - добавить новую покупку\n"
+    "• 🎁 Использовать баллы - потратить баллы на скидку\n"
+    "• 👤 Мой профиль - ваши данные\n"
+    "• 📋 Правила - правила программы\n\n"
+    "👑 *Для администраторов:*\n"
+    "Используйте /admin для доступа к панели управления\n\n"
+    f"📞 *Поддержка:*\n"
+    f"Сервер: {WEBHOOK_URL}"
+)
+
+SETTINGS_MESSAGE = (
+    "⚙️ *Настройки системы:*\n\n"
+    f"🎯 *Текущие настройки:*\n"
+    f"• Баллов за рубль: {POINTS_PER_PURCHASE_PCT}%\n"
+    f"• Скидка за балл: {DISCOUNT_PER_POINT_PCT}%\n"
+    f"• Макс. скидка: {MAX_DISCOUNT}%\n"
+    f"• Бонус за регистрацию: {WELCOME_BONUS}\n"
+    f"• Бонус на день рождения: {BIRTHDAY_BONUS}\n\n"
+    f"⚠️ Для изменения настроек требуется редактирование кода.\n\n"
+    f"📊 *Техническая информация:*\n"
+    f"• Бот токен: {'Установлен' if BOT_TOKEN else 'Не установлен'}\n"
+    f"• Админ ID: {YOUR_TELEGRAM_ID}\n"
+    f"• База данных: {DB_NAME}\n"
+    f"• Вебхук URL: {WEBHOOK_URL}/evotor/webhook"
+)
+
+STARTUP_INSTRUCTIONS = (
+    "\n✅ Система готова к работе!\n"
+    "\n📱 *Инструкция:*\n"
+    "1. Откройте Telegram и найдите вашего бота\n"
+    "2. Нажмите START или отправьте /start\n"
+    "3. Следуйте инструкциям регистрации\n"
+    "4. Получите QR код для кассы\n"
+    "\n👑 *Админ панель:*\n"
+    "• Отправьте команду /admin\n"
+    f"• Или используйте Telegram ID: {YOUR_TELEGRAM_ID}\n"
+    "\n🌐 *Интеграция с Эвотор:*\n"
+    f"1. URL вебхука: {WEBHOOK_URL}/evotor/webhook\n"
+    "2. Установите скрипт на терминал Эвотор\n"
+    "3. Клиенты показывают QR код на кассе\n"
+    "4. Баллы начисляются автоматически\n"
+    + "=" * 60
+)
+
 
 # ================== БАЗА ДАННЫХ (ОБЪЕДИНЕННАЯ) ==================
+# SQL запросы вынесены в константы: sqlite3 кэширует подготовленные
+# выражения по тексту запроса, и повторный вызов не разбирает SQL заново
+
+# Колонки, из которых собирается user_info
+_USER_INFO_COLUMNS = '''
+    user_id, name, phone, gender, total_purchases,
+    total_points, current_points, registration_date, qr_code, qr_file_id
+'''
+
+_SQL_SELECT_USER_BY_TELEGRAM = f'SELECT {_USER_INFO_COLUMNS} FROM users WHERE telegram_id = ?'
+
+_SQL_INSERT_USER = '''
+    INSERT INTO users (telegram_id, name, phone, gender, current_points)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+_SQL_SET_QR_CODE = f'UPDATE users SET qr_code = ? WHERE user_id = ? RETURNING {_USER_INFO_COLUMNS}'
+
+_SQL_SET_QR_FILE_ID = 'UPDATE users SET qr_file_id = ? WHERE telegram_id = ?'
+
+_SQL_INSERT_BONUS = '''
+    INSERT INTO transactions (user_id, type, points_change, description)
+    VALUES (?, 'bonus', ?, 'Бонус за регистрацию')
+'''
+
+_SQL_ADD_PURCHASE_BY_QR = '''
+    UPDATE users
+    SET total_purchases = total_purchases + ?,
+        total_points = total_points + ?,
+        current_points = current_points + ?
+    WHERE qr_code = ? AND is_active = 1
+    RETURNING user_id, telegram_id, current_points
+'''
+
+_SQL_ADD_PURCHASE = '''
+    UPDATE users
+    SET total_purchases = total_purchases + ?,
+        total_points = total_points + ?,
+        current_points = current_points + ?
+    WHERE telegram_id = ? AND is_active = 1
+    RETURNING user_id, current_points
+'''
+
+_SQL_INSERT_PURCHASE = '''
+    INSERT INTO transactions (user_id, type, amount, points_change, description)
+    VALUES (?, 'purchase', ?, ?, ?)
+'''
+
+# Проверка баланса и списание - один атомарный оператор: баланс не уйдёт
+# в минус даже при одновременных списаниях, без чтения перед записью
+_SQL_SPEND_POINTS = '''
+    UPDATE users
+    SET current_points = current_points - ?
+    WHERE telegram_id = ? AND is_active = 1 AND current_points >= ?
+    RETURNING user_id, current_points
+'''
+
+_SQL_SELECT_POINTS = 'SELECT current_points FROM users WHERE telegram_id = ? AND is_active = 1'
+
+_SQL_INSERT_SPEND = '''
+    INSERT INTO transactions (user_id, type, points_change, description)
+    VALUES (?, 'spend', ?, ?)
+'''
+
+_SQL_SELECT_USER_INFO = f'''
+    SELECT {_USER_INFO_COLUMNS}
+    FROM users
+    WHERE telegram_id = ? AND is_active = 1
+'''
+
+_SQL_SELECT_USER_BY_ID = '''
+    SELECT user_id, telegram_id, name, phone, gender, total_purchases,
+           total_points, current_points, registration_date, qr_code
+    FROM users
+    WHERE user_id = ?
+'''
+
+_SQL_SELECT_TRANSACTIONS = '''
+    SELECT type, amount, points_change, description, timestamp
+    FROM transactions
+    WHERE user_id = ?
+    ORDER BY timestamp DESC
+    LIMIT ?
+'''
+
+_SQL_SELECT_USERS_PAGE = '''
+    SELECT user_id, telegram_id, name, phone, total_purchases,
+           current_points, registration_date, qr_code
+    FROM users
+    WHERE is_active = 1
+    ORDER BY registration_date DESC
+    LIMIT ? OFFSET ?
+'''
+
+_SQL_ADMIN_UPDATE_POINTS = '''
+    UPDATE users
+    SET current_points = current_points + ?,
+        total_points = total_points + ?
+    WHERE user_id = ?
+    RETURNING current_points, telegram_id
+'''
+
+_SQL_INSERT_ADMIN = '''
+    INSERT INTO transactions (user_id, type, points_change, description)
+    VALUES (?, 'admin', ?, ?)
+'''
+
+# Счётчики статистики ведутся в одной строке таблицы stats и меняются
+# в той же транзакции, что и основная запись
+_SQL_SEED_STATS = '''
+    INSERT OR IGNORE INTO stats (id, total_users, total_sales, total_points_outstanding)
+    SELECT 1, COUNT(*), COALESCE(SUM(total_purchases), 0), COALESCE(SUM(current_points), 0)
+    FROM users
+    WHERE is_active = 1
+'''
+
+_SQL_STATS_ADD_USER = '''
+    UPDATE stats
+    SET total_users = total_users + 1,
+        total_points_outstanding = total_points_outstanding + ?
+    WHERE id = 1
+'''
+
+_SQL_STATS_ADD_SALE = '''
+    UPDATE stats
+    SET total_sales = total_sales + ?,
+        total_points_outstanding = total_points_outstanding + ?
+    WHERE id = 1
+'''
+
+_SQL_STATS_ADD_POINTS = '''
+    UPDATE stats
+    SET total_points_outstanding = total_points_outstanding + ?
+    WHERE id = 1
+'''
+
+_SQL_SYSTEM_STATS = 'SELECT total_users, total_sales, total_points_outstanding FROM stats WHERE id = 1'
+
+# Время жизни записи в кэше пользователей, секунд. Все записи через LoyaltyDB
+# сбрасывают кэш сами, TTL нужен только на случай правок базы в обход бота
+USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 300))
+
+
 class LoyaltyDB:
     def __init__(self, db_name: str = DB_NAME):
         self.db_name = db_name
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        self._local = threading.local()
+        # Кэш get_user_info: telegram_id -> (срок действия, данные)
+        self._user_cache: Dict[int, Tuple[float, dict]] = {}
+        self._cache_generation = 0
+        self._cache_lock = threading.Lock()
+        self._dirty_users: List[int] = []
         self.init_database()
         logger.info(f"База данных инициализирована: {db_name}")
 
+    def _connect(self) -> sqlite3.Connection:
+        """Открытие постоянного соединения с БД"""
+        conn = sqlite3.connect(self.db_name, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        # WAL: чтение не блокируется записью, кэш страниц живёт между запросами
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-20000')
+        conn.execute('PRAGMA mmap_size=268435456')
+        conn.execute('PRAGMA foreign_keys=ON')
+        conn.execute('PRAGMA cache_spill=0')
+        # Строки с доступом по имени колонки, dict(row) собирается на уровне C
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """Соединение только для чтения, своё у каждого потока"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            conn.execute('PRAGMA query_only=ON')
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Транзакция записи: все операторы фиксируются одним COMMIT"""
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                yield cursor
+                # COMMIT тоже может упасть (SQLITE_BUSY, нет места на диске):
+                # тогда откатываем, иначе соединение останется в открытой транзакции
+                cursor.execute('COMMIT')
+            except BaseException:
+                if self._conn.in_transaction:
+                    cursor.execute('ROLLBACK')
+                self._dirty_users.clear()
+                raise
+            # Сбрасываем кэш только после COMMIT, иначе читатель успеет
+            # положить в него старые данные
+            if self._dirty_users:
+                with self._cache_lock:
+                    self._cache_generation += 1
+                    for telegram_id in self._dirty_users:
+                        self._user_cache.pop(telegram_id, None)
+                self._dirty_users.clear()
+
+    def _mark_dirty(self, telegram_id: int):
+        """Пометить пользователя для сброса кэша после COMMIT"""
+        self._dirty_users.append(telegram_id)
+
+    def ping(self):
+        """Проверка соединения с БД"""
+        with self._lock:
+            self._conn.execute('SELECT 1').fetchone()
+
     def init_database(self):
         """Инициализация базы данных"""
         try:
-            with sqlite3.connect(self.db_name) as conn:
-                cursor = conn.cursor()
+            with self._lock:
+                cursor = self._conn.cursor()
 
                 # Таблица пользователей
                 cursor.execute('''
@@ -114,10 +419,16 @@ class LoyaltyDB:
                         total_points INTEGER DEFAULT 0,
                         current_points INTEGER DEFAULT 0,
                         qr_code TEXT UNIQUE,
-                        is_active BOOLEAN DEFAULT 1
+                        is_active BOOLEAN DEFAULT 1,
+                        qr_file_id TEXT
                     )
                 ''')
 
+                # file_id картинки с QR кодом в Telegram (для старых баз)
+                cursor.execute('PRAGMA table_info(users)')
+                if 'qr_file_id' not in {row[1] for row in cursor.fetchall()}:
+                    cursor.execute('ALTER TABLE users ADD COLUMN qr_file_id TEXT')
+
                 # Таблица транзакций
                 cursor.execute('''
                     CREATE TABLE IF NOT EXISTS transactions (
@@ -132,12 +443,33 @@ class LoyaltyDB:
                     )
                 ''')
 
+                # Счётчики для статистики админа, при первом запуске
+                # заполняются по существующим пользователям
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS stats (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        total_users INTEGER NOT NULL DEFAULT 0,
+                        total_sales REAL NOT NULL DEFAULT 0,
+                        total_points_outstanding INTEGER NOT NULL DEFAULT 0
+                    )
+                ''')
+                cursor.execute(_SQL_SEED_STATS)
+
                 # Индексы для быстрого поиска
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_telegram ON users(telegram_id)')
                 cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_qr ON users(qr_code)')
-                cursor.execute('CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions(user_id)')
+                # Страница списка пользователей для админа читается по индексу
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_reg_date ON users(registration_date DESC)')
+                # История пользователя читается индексом сразу в нужном порядке,
+                # без сортировки; старый индекс только по user_id становится лишним
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_txn_user_ts'")
+                new_history_index = cursor.fetchone() is None
+                cursor.execute('CREATE INDEX IF NOT EXISTS idx_txn_user_ts ON transactions(user_id, timestamp DESC)')
+                cursor.execute('DROP INDEX IF EXISTS idx_transactions_user')
+                if new_history_index:
+                    # Собираем статистику, чтобы планировщик выбрал новый индекс
+                    cursor.execute('ANALYZE')
 
-                conn.commit()
                 logger.info("Таблицы базы данных созданы/проверены")
         except Exception as e:
             logger.error(f"Ошибка инициализации БД: {e}")
@@ -145,310 +477,376 @@ class LoyaltyDB:
 
     def generate_qr_code(self, user_id: int) -> str:
         """Генерация QR кода в формате XXX-XXX"""
-        return f"{str(user_id).zfill(3)}-{hashlib.md5(str(user_id).encode()).hexdigest()[:3]}"
-
-    def add_user(self, telegram_id: int, name: str = None, phone: str = None, gender: str = None) -> Tuple[int, str]:
-        """Добавление нового пользователя с QR кодом"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+        # Мультипликативный хеш Кнута вместо MD5: несколько целочисленных операций
+        return f"{user_id:03d}-{(user_id * 2654435761) & 0xFFF:03x}"
 
+    def add_user(self, telegram_id: int, name: str = None, phone: str = None, gender: str = None) -> dict:
+        """Добавление нового пользователя с QR кодом, возвращает user_info"""
+        with self._transaction() as cursor:
             # Проверяем, существует ли пользователь
-            cursor.execute('SELECT user_id, qr_code FROM users WHERE telegram_id = ?', (telegram_id,))
+            cursor.execute(_SQL_SELECT_USER_BY_TELEGRAM, (telegram_id,))
             existing = cursor.fetchone()
 
             if existing:
                 logger.info(f"Пользователь {telegram_id} уже существует")
-                return existing[0], existing[1] or self.generate_qr_code(existing[0])
+                user_info = dict(existing)
+                user_info['qr_code'] = user_info['qr_code'] or self.generate_qr_code(user_info['user_id'])
+                return user_info
 
             # Добавляем нового пользователя
-            cursor.execute('''
-                INSERT INTO users (telegram_id, name, phone, gender, current_points)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (telegram_id, name, phone, gender, LOYALTY_SETTINGS['welcome_bonus']))
+            cursor.execute(_SQL_INSERT_USER,
+                           (telegram_id, name, phone, gender, WELCOME_BONUS))
 
             user_id = cursor.lastrowid
             qr_code = self.generate_qr_code(user_id)
 
-            # Обновляем QR код
-            cursor.execute('UPDATE users SET qr_code = ? WHERE user_id = ?', (qr_code, user_id))
+            # Обновляем QR код и получаем итоговые данные пользователя
+            cursor.execute(_SQL_SET_QR_CODE, (qr_code, user_id))
+            user_info = dict(cursor.fetchone())
 
             # Добавляем транзакцию бонуса
-            cursor.execute('''
-                INSERT INTO transactions (user_id, type, points_change, description)
-                VALUES (?, 'bonus', ?, 'Бонус за регистрацию')
-            ''', (user_id, LOYALTY_SETTINGS['welcome_bonus']))
+            cursor.execute(_SQL_INSERT_BONUS, (user_id, WELCOME_BONUS))
+            cursor.execute(_SQL_STATS_ADD_USER, (WELCOME_BONUS,))
+            self._mark_dirty(telegram_id)
 
-            conn.commit()
             logger.info(f"Создан новый пользователь: ID={user_id}, QR={qr_code}")
-            return user_id, qr_code
-
-    def get_user_by_qr(self, qr_code: str) -> Optional[Tuple]:
-        """Получение пользователя по QR коду"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT telegram_id, current_points, user_id FROM users 
-                WHERE qr_code = ? AND is_active = 1
-            ''', (qr_code,))
-            return cursor.fetchone()
+            return user_info
 
     def add_purchase_by_qr(self, qr_code: str, amount: float) -> Optional[Tuple]:
         """Добавление покупки по QR коду (для webhook)"""
-        row = self.get_user_by_qr(qr_code)
-        if not row:
-            logger.warning(f"Пользователь с QR={qr_code} не найден")
-            return None
-
-        telegram_id, current_points, user_id = row
-        earned = int(amount * LOYALTY_SETTINGS['points_per_purchase'])
-
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-
-            # Обновляем баланс пользователя
-            cursor.execute('''
-                UPDATE users 
-                SET total_purchases = total_purchases + ?,
-                    total_points = total_points + ?,
-                    current_points = current_points + ?
-                WHERE qr_code = ?
-            ''', (amount, earned, earned, qr_code))
-
-            # Добавляем транзакцию
-            cursor.execute('''
-                INSERT INTO transactions (user_id, type, amount, points_change, description)
-                VALUES (?, 'purchase', ?, ?, ?)
-            ''', (user_id, amount, earned, f'Покупка на сумму {amount} руб. (через Эвотор)'))
+        return self.add_purchases_bulk([(qr_code, amount)])[0]
+
+    def add_purchases_bulk(self, rows: List[Tuple[str, float]]) -> List[Optional[Tuple]]:
+        """Добавление пачки покупок по QR кодам одной транзакцией
+
+        Возвращает для каждой покупки (telegram_id, баллы, новый баланс)
+        или None, если пользователь не найден или сумма некорректна.
+        """
+        results = []
+        purchases = []
+        total_amount = 0
+        total_earned = 0
+
+        with self._transaction() as cursor:
+            for qr_code, amount in rows:
+                # Некорректная сумма не должна откатить остальные покупки пачки
+                if not (math.isfinite(amount) and amount > 0):
+                    logger.warning(f"Некорректная сумма покупки: QR={qr_code}, сумма={amount}")
+                    results.append(None)
+                    continue
+                earned = int(amount * POINTS_PER_PURCHASE)
+
+                # Обновляем баланс пользователя и сразу получаем новый
+                cursor.execute(_SQL_ADD_PURCHASE_BY_QR, (amount, earned, earned, qr_code))
+                row = cursor.fetchone()
+                if not row:
+                    logger.warning(f"Пользователь с QR={qr_code} не найден")
+                    results.append(None)
+                    continue
+
+                user_id, telegram_id, new_balance = row
+                self._mark_dirty(telegram_id)
+                purchases.append((user_id, amount, earned, f'Покупка на сумму {amount} руб. (через Эвотор)'))
+                total_amount += amount
+                total_earned += earned
+                results.append((telegram_id, earned, new_balance))
+
+                logger.info(f"Начислено баллов: QR={qr_code}, сумма={amount}, баллы={earned}, новый баланс={new_balance}")
+
+            # Транзакции и счётчики пишем разом для всей пачки
+            if purchases:
+                cursor.executemany(_SQL_INSERT_PURCHASE, purchases)
+                cursor.execute(_SQL_STATS_ADD_SALE, (total_amount, total_earned))
+
+        return results
+
+    def add_purchase(self, telegram_id: int, amount: float) -> Optional[Tuple[int, int]]:
+        """Добавление покупки через бота, None - пользователь не найден"""
+        with self._transaction() as cursor:
+            points_earned = int(amount * POINTS_PER_PURCHASE)
+
+            # Пользователь ищется по Telegram ID, user_id для истории возвращает сам UPDATE
+            cursor.execute(_SQL_ADD_PURCHASE, (amount, points_earned, points_earned, telegram_id))
+            row = cursor.fetchone()
+            if not row:
+                return None
 
-            conn.commit()
+            user_id, new_balance = row
+            self._mark_dirty(telegram_id)
 
-            # Получаем новый баланс
-            cursor.execute('SELECT current_points FROM users WHERE user_id = ?', (user_id,))
-            new_balance = cursor.fetchone()[0]
+            cursor.execute(_SQL_INSERT_PURCHASE,
+                           (user_id, amount, points_earned, f'Покупка на сумму {amount} руб.'))
+            cursor.execute(_SQL_STATS_ADD_SALE, (amount, points_earned))
 
-            logger.info(f"Начислено баллов: QR={qr_code}, сумма={amount}, баллы={earned}, новый баланс={new_balance}")
-            return telegram_id, earned, new_balance
+            return points_earned, new_balance
 
-    def add_purchase(self, user_id: int, amount: float) -> Tuple[int, float]:
-        """Добавление покупки через бота"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            points_earned = int(amount * LOYALTY_SETTINGS['points_per_purchase'])
+    def spend_points(self, telegram_id: int, points_to_spend: int, purchase_amount: float = None) -> Tuple[
+        bool, int, float]:
+        """Списание баллов"""
+        requested_points = points_to_spend
 
-            cursor.execute('''
-                UPDATE users 
-                SET total_purchases = total_purchases + ?,
-                    total_points = total_points + ?,
-                    current_points = current_points + ?
-                WHERE user_id = ?
-            ''', (amount, points_earned, points_earned, user_id))
+        # Рассчитываем максимальное количество баллов для скидки
+        max_points_for_discount = 0
+        if purchase_amount:
+            max_discount_amount = purchase_amount * MAX_DISCOUNT / 100
+            max_points_for_discount = int(max_discount_amount / DISCOUNT_PER_POINT)
 
-            cursor.execute('''
-                INSERT INTO transactions (user_id, type, amount, points_change, description)
-                VALUES (?, 'purchase', ?, ?, ?)
-            ''', (user_id, amount, points_earned, f'Покупка на сумму {amount} руб.'))
+        if purchase_amount and points_to_spend > max_points_for_discount:
+            points_to_spend = max_points_for_discount
 
-            conn.commit()
+        # Рассчитываем скидку
+        discount = points_to_spend * DISCOUNT_PER_POINT
+        if purchase_amount:
+            discount_amount = purchase_amount * discount / 100
+            discount = min(discount, MAX_DISCOUNT)
 
-            cursor.execute('SELECT current_points FROM users WHERE user_id = ?', (user_id,))
-            new_balance = cursor.fetchone()[0]
+        with self._transaction() as cursor:
+            # Списание баллов, только если их хватает на запрошенное количество
+            cursor.execute(_SQL_SPEND_POINTS, (points_to_spend, telegram_id, requested_points))
+            row = cursor.fetchone()
 
-            return points_earned, new_balance
+            if not row:
+                cursor.execute(_SQL_SELECT_POINTS, (telegram_id,))
+                row = cursor.fetchone()
+                return False, row[0] if row else 0, 0.0
 
-    def spend_points(self, user_id: int, points_to_spend: int, purchase_amount: float = None) -> Tuple[
-        bool, int, float]:
-        """Списание баллов"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT current_points FROM users WHERE user_id = ?', (user_id,))
-            current_points = cursor.fetchone()[0]
-
-            if current_points < points_to_spend:
-                return False, current_points, 0.0
-
-            # Рассчитываем максимальное количество баллов для скидки
-            max_points_for_discount = 0
-            if purchase_amount:
-                max_discount_amount = purchase_amount * LOYALTY_SETTINGS['max_discount'] / 100
-                max_points_for_discount = int(max_discount_amount / LOYALTY_SETTINGS['discount_per_point'])
-
-            if purchase_amount and points_to_spend > max_points_for_discount:
-                points_to_spend = max_points_for_discount
-
-            # Рассчитываем скидку
-            discount = points_to_spend * LOYALTY_SETTINGS['discount_per_point']
-            if purchase_amount:
-                discount_amount = purchase_amount * discount / 100
-                discount = min(discount, LOYALTY_SETTINGS['max_discount'])
-
-            # Списание баллов
-            cursor.execute('''
-                UPDATE users 
-                SET current_points = current_points - ? 
-                WHERE user_id = ?
-            ''', (points_to_spend, user_id))
+            user_id, new_balance = row
+            self._mark_dirty(telegram_id)
 
             # Добавляем транзакцию
-            cursor.execute('''
-                INSERT INTO transactions (user_id, type, points_change, description)
-                VALUES (?, 'spend', ?, ?)
-            ''', (user_id, -points_to_spend, f'Списание {points_to_spend} баллов, скидка {discount:.1f}%'))
-
-            conn.commit()
-
-            cursor.execute('SELECT current_points FROM users WHERE user_id = ?', (user_id,))
-            new_balance = cursor.fetchone()[0]
+            cursor.execute(_SQL_INSERT_SPEND,
+                           (user_id, -points_to_spend, f'Списание {points_to_spend} баллов, скидка {discount:.1f}%'))
+            cursor.execute(_SQL_STATS_ADD_POINTS, (-points_to_spend,))
 
             return True, new_balance, discount
 
+    def get_cached_user_info(self, telegram_id: int) -> Optional[dict]:
+        """Информация о пользователе из кэша, без обращения к БД"""
+        cached = self._user_cache.get(telegram_id)
+        if cached and cached[0] > time.monotonic():
+            return dict(cached[1])
+        return None
+
     def get_user_info(self, telegram_id: int) -> Optional[dict]:
         """Получение информации о пользователе"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id, name, phone, gender, total_purchases, 
-                       total_points, current_points, registration_date, qr_code
-                FROM users 
-                WHERE telegram_id = ? AND is_active = 1
-            ''', (telegram_id,))
-            row = cursor.fetchone()
+        cached = self.get_cached_user_info(telegram_id)
+        if cached:
+            return cached
 
-            if not row:
-                return None
+        generation = self._cache_generation
+        cursor = self._reader().cursor()
+        cursor.execute(_SQL_SELECT_USER_INFO, (telegram_id,))
+        row = cursor.fetchone()
+
+        if not row:
+            return None
+
+        user_info = dict(row)
+        # Не кэшируем, если пока шёл запрос, кто-то успел записать
+        with self._cache_lock:
+            if generation == self._cache_generation:
+                self._user_cache[telegram_id] = (time.monotonic() + USER_CACHE_TTL, user_info)
+        return dict(user_info)
 
-            return {
-                'user_id': row[0],
-                'name': row[1],
-                'phone': row[2],
-                'gender': row[3],
-                'total_purchases': row[4],
-                'total_points': row[5],
-                'current_points': row[6],
-                'registration_date': row[7],
-                'qr_code': row[8]
-            }
+    def set_qr_file_id(self, telegram_id: int, file_id: str):
+        """Сохранение file_id отправленной в Telegram картинки с QR кодом"""
+        with self._transaction() as cursor:
+            cursor.execute(_SQL_SET_QR_FILE_ID, (file_id, telegram_id))
+            self._mark_dirty(telegram_id)
 
     def get_user_by_id(self, user_id: int) -> Optional[dict]:
         """Получение пользователя по ID"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            row = cursor.fetchone()
+        cursor = self._reader().cursor()
+        cursor.execute(_SQL_SELECT_USER_BY_ID, (user_id,))
+        row = cursor.fetchone()
 
-            if not row:
-                return None
+        if not row:
+            return None
 
-            columns = [desc[0] for desc in cursor.description]
-            return dict(zip(columns, row))
+        return dict(row)
 
     def get_user_transactions(self, user_id: int, limit: int = 10) -> list:
         """Получение последних транзакций"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT type, amount, points_change, description, timestamp
-                FROM transactions 
-                WHERE user_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT ?
-            ''', (user_id, limit))
-
-            return [
-                {
-                    'type': row[0],
-                    'amount': row[1],
-                    'points_change': row[2],
-                    'description': row[3],
-                    'timestamp': row[4]
-                }
-                for row in cursor.fetchall()
-            ]
-
-    def get_all_users(self, limit: int = 100, offset: int = 0) -> Tuple[List[dict], int]:
-        """Получение всех пользователей (для админа)"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT user_id, telegram_id, name, phone, total_purchases, 
-                       current_points, registration_date, qr_code
-                FROM users 
-                WHERE is_active = 1 
-                ORDER BY registration_date DESC 
-                LIMIT ? OFFSET ?
-            ''', (limit, offset))
-
-            users = []
-            for row in cursor.fetchall():
-                users.append({
-                    'user_id': row[0],
-                    'telegram_id': row[1],
-                    'name': row[2],
-                    'phone': row[3],
-                    'total_purchases': row[4],
-                    'current_points': row[5],
-                    'registration_date': row[6],
-                    'qr_code': row[7]
-                })
-
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-            total = cursor.fetchone()[0]
-            return users, total
-
-    def update_user_points(self, user_id: int, points: int,
-                           description: str = "Изменение баланса администратором") -> bool:
-        """Изменение баланса пользователя (админ)"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            try:
-                cursor.execute('''
-                    UPDATE users 
-                    SET current_points = current_points + ?,
-                        total_points = total_points + ?
-                    WHERE user_id = ?
-                ''', (points, max(0, points), user_id))
+        cursor = self._reader().cursor()
+        cursor.execute(_SQL_SELECT_TRANSACTIONS, (user_id, limit))
+        return [dict(row) for row in cursor]
 
-                cursor.execute('''
-                    INSERT INTO transactions (user_id, type, points_change, description)
-                    VALUES (?, 'admin', ?, ?)
-                ''', (user_id, points, description))
+    def get_users_page(self, limit: int = 100, offset: int = 0) -> List[dict]:
+        """Страница списка пользователей (для админа)"""
+        cursor = self._reader().cursor()
+        cursor.execute(_SQL_SELECT_USERS_PAGE, (limit, offset))
+        return [dict(row) for row in cursor]
 
-                conn.commit()
-                return True
-            except Exception as e:
-                logger.error(f"Ошибка обновления баллов: {e}")
-                return False
+    def update_user_points(self, user_id: int, points: int,
+                           description: str = "Изменение баланса администратором") -> Optional[int]:
+        """Изменение баланса пользователя (админ), возвращает новый баланс"""
+        try:
+            with self._transaction() as cursor:
+                # Списание не уменьшает total_points - это сумма всех начислений
+                cursor.execute(_SQL_ADMIN_UPDATE_POINTS, (points, max(0, points), user_id))
+                row = cursor.fetchone()
+                if not row:
+                    logger.warning(f"Пользователь с ID={user_id} не найден")
+                    return None
+
+                new_balance, telegram_id = row
+                self._mark_dirty(telegram_id)
+                cursor.execute(_SQL_INSERT_ADMIN, (user_id, points, description))
+                cursor.execute(_SQL_STATS_ADD_POINTS, (points,))
+
+            return new_balance
+        except Exception as e:
+            logger.error(f"Ошибка обновления баллов: {e}")
+            return None
 
     def get_system_stats(self) -> dict:
         """Получение статистики системы"""
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            stats = {}
-
-            cursor.execute('''
-                SELECT COUNT(*) as total_users,
-                       SUM(total_purchases) as total_sales,
-                       SUM(current_points) as total_points,
-                       AVG(total_purchases) as avg_purchase
-                FROM users 
-                WHERE is_active = 1
-            ''')
+        cursor = self._reader().cursor()
+        cursor.execute(_SQL_SYSTEM_STATS)
+        total_users, total_sales, total_points = cursor.fetchone()
 
-            row = cursor.fetchone()
-            stats.update({
-                'total_users': row[0] or 0,
-                'total_sales': row[1] or 0,
-                'total_points': row[2] or 0,
-                'avg_purchase': row[3] or 0
-            })
-
-            return stats
+        return {
+            'total_users': total_users,
+            'total_sales': total_sales,
+            'total_points': total_points,
+            'avg_purchase': total_sales / total_users if total_users else 0
+        }
 
 
 # Инициализация базы данных
 db = LoyaltyDB()
 
+# SQLite допускает только одного писателя: все записи идут через один поток,
+# чтения - через отдельный пул и в режиме WAL не ждут записи
+db_write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+db_read_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='db-read')
+
+
+async def db_write(func, *args):
+    """Выполнение записи в БД вне event loop"""
+    return await asyncio.get_running_loop().run_in_executor(db_write_pool, func, *args)
+
+
+async def db_read(func, *args):
+    """Выполнение чтения из БД вне event loop"""
+    return await asyncio.get_running_loop().run_in_executor(db_read_pool, func, *args)
+
+
+async def get_user_info(telegram_id: int) -> Optional[dict]:
+    """Информация о пользователе: из кэша прямо в event loop, при промахе - из БД"""
+    return db.get_cached_user_info(telegram_id) or await db_read(db.get_user_info, telegram_id)
+
+
+# Статистика для админа приблизительная: повторные нажатия и /status
+# в течение STATS_CACHE_TTL секунд получают уже прочитанный результат
+STATS_CACHE_TTL = 30
+_stats_cache: Tuple[float, dict] = (0.0, {})
+
+
+async def get_system_stats() -> dict:
+    """Статистика системы с кэшированием"""
+    global _stats_cache
+    checked_at, stats = _stats_cache
+    now = time.monotonic()
+    if stats and now - checked_at < STATS_CACHE_TTL:
+        return dict(stats)
+
+    stats = await db_read(db.get_system_stats)
+    _stats_cache = (now, stats)
+    return dict(stats)
+
 # ================== FASTAPI ВЕБ-ПРИЛОЖЕНИЕ ==================
-app = FastAPI(title="Система лояльности Эвотор", version="1.0")
+# Ответы сериализуются через orjson, как и разбор входящих вебхуков
+app = FastAPI(title="Система лояльности Эвотор", version="1.0", default_response_class=ORJSONResponse)
+
+# Уведомления о покупках отправляются фоновой задачей, чтобы вебхук
+# отвечал Эвотор сразу, не дожидаясь ответа Telegram
+NOTIFY_QUEUE_SIZE = 1000
+notify_queue: Optional[asyncio.Queue] = None
+notify_task: Optional[asyncio.Task] = None
+
+
+# Покупки из вебхука копятся в очереди и записываются в БД пачками:
+# одна транзакция и один COMMIT на всю пачку вместо одного на чек
+PURCHASE_BATCH_SIZE = 100
+PURCHASE_BATCH_DELAY = 0.05
+purchase_queue: Optional[asyncio.Queue] = None
+purchase_task: Optional[asyncio.Task] = None
+
+
+async def purchase_worker():
+    """Запись накопленных покупок в БД"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await purchase_queue.get()]
+        deadline = loop.time() + PURCHASE_BATCH_DELAY
+        while len(batch) < PURCHASE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(purchase_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        try:
+            results = await db_write(db.add_purchases_bulk, [(qr_code, amount) for qr_code, amount, _ in batch])
+        except Exception as e:
+            logger.error(f"Ошибка записи пачки покупок, записываем по одной: {e}")
+            # Пачка откатилась целиком: повторяем по одной, чтобы ошибка
+            # досталась только своему чеку
+            for qr_code, amount, future in batch:
+                try:
+                    result = await db_write(db.add_purchase_by_qr, qr_code, amount)
+                except Exception as item_error:
+                    if not future.done():
+                        future.set_exception(item_error)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+            continue
+
+        for (_, _, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+async def add_purchase_batched(qr_code: str, amount: float) -> Optional[Tuple]:
+    """Добавление покупки через очередь пакетной записи"""
+    future = asyncio.get_running_loop().create_future()
+    await purchase_queue.put((qr_code, amount, future))
+    return await future
+
+
+async def notification_worker():
+    """Отправка уведомлений из очереди"""
+    while True:
+        chat_id, text = await notify_queue.get()
+        try:
+            await application.bot.send_message(chat_id=chat_id, text=text)
+            logger.info(f"Уведомление отправлено пользователю {chat_id}")
+        except Exception as e:
+            logger.error(f"Ошибка отправки уведомления: {e}")
+        finally:
+            notify_queue.task_done()
+
+
+@app.on_event("startup")
+async def start_notification_worker():
+    """Запуск фоновой отправки уведомлений и записи покупок"""
+    global notify_queue, notify_task, purchase_queue, purchase_task
+    notify_queue = asyncio.Queue(maxsize=NOTIFY_QUEUE_SIZE)
+    notify_task = asyncio.create_task(notification_worker())
+    purchase_queue = asyncio.Queue()
+    purchase_task = asyncio.create_task(purchase_worker())
+
+
+@app.on_event("shutdown")
+async def stop_notification_worker():
+    """Остановка фоновой отправки уведомлений и записи покупок"""
+    for task in (notify_task, purchase_task):
+        if task:
+            task.cancel()
 
 
 @app.get("/")
@@ -462,30 +860,42 @@ async def root():
     }
 
 
+# Результат проверки БД переиспользуется: Render опрашивает /health каждые несколько секунд
+HEALTH_CACHE_TTL = 10
+_health_cache: Tuple[float, dict] = (0.0, {})
+
+
 @app.get("/health")
 async def health_check():
     """Проверка здоровья сервера"""
+    global _health_cache
+    checked_at, result = _health_cache
+    now = time.monotonic()
+    if result and now - checked_at < HEALTH_CACHE_TTL:
+        return result
+
     try:
         # Проверяем подключение к БД
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT 1")
-        return {"status": "healthy", "database": "connected"}
+        await db_read(db.ping)
+        result = {"status": "healthy", "database": "connected"}
     except Exception as e:
-        return {"status": "unhealthy", "error": str(e)}
+        result = {"status": "unhealthy", "error": str(e)}
+    _health_cache = (now, result)
+    return result
 
 
 @app.post("/evotor/webhook")
 async def evotor_webhook(request: Request):
     """Обработчик вебхука от Эвотор"""
     try:
-        # Пробуем разные форматы данных
+        # Тело читаем один раз и разбираем прямо из байтов
+        # (данные приходят как с application/json, так и текстом)
+        body = await request.body()
         try:
-            data = await request.json()
-        except:
-            # Иногда данные приходят как текст
-            body = await request.body()
-            data = json.loads(body.decode())
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            logger.warning(f"Некорректный JSON в вебхуке: {body[:200]!r}")
+            return {"status": "error", "message": "Invalid JSON"}
         
         logger.info(f"Получен вебхук: {data}")
         
@@ -512,26 +922,27 @@ async def evotor_webhook(request: Request):
             total_float = float(total)
         except:
             return {"status": "error", "message": "Invalid total format"}
+        if not (math.isfinite(total_float) and total_float > 0):
+            return {"status": "error", "message": "Invalid total format"}
         
-        result = db.add_purchase_by_qr(qr_code, total_float)
+        result = await add_purchase_batched(qr_code, total_float)
         if not result:
             logger.warning(f"Пользователь не найден: QR={qr_code}")
             return {"status": "not_found", "message": "Client not found"}
         
         telegram_id, earned, balance = result
         
-        # Отправляем уведомление пользователю через бота
+        # Ставим уведомление пользователю в очередь
         if application and hasattr(application, 'bot'):
             try:
-                await application.bot.send_message(
-                    chat_id=telegram_id,
-                    text=f"🧾 Покупка: {total_float} ₽\n"
-                         f"🎁 Начислено: {earned} баллов\n"
-                         f"💰 Баланс: {balance}"
-                )
-                logger.info(f"Уведомление отправлено пользователю {telegram_id}")
-            except Exception as e:
-                logger.error(f"Ошибка отправки уведомления: {e}")
+                notify_queue.put_nowait((
+                    telegram_id,
+                    f"🧾 Покупка: {total_float} ₽\n"
+                    f"🎁 Начислено: {earned} баллов\n"
+                    f"💰 Баланс: {balance}"
+                ))
+            except asyncio.QueueFull:
+                logger.error(f"Очередь уведомлений переполнена, пользователь {telegram_id} не уведомлён")
         
         return {
             "status": "ok",
@@ -548,35 +959,83 @@ async def evotor_webhook(request: Request):
 # ==================== TELEGRAM БОТ ====================
 
 # ==================== КНОПКИ И КЛАВИАТУРЫ ====================
-def get_main_keyboard():
-    """Основная клавиатура для пользователей"""
-    keyboard = [
-        ["💰 Мой баланс", "📊 История операций"],
-        ["➕ Добавить покупку", "🎁 Использовать баллы"],
-        ["👤 Мой профиль", "📋 Правила"],
-        ["🆘 Помощь"]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+# Клавиатуры не меняются, поэтому создаются один раз при загрузке модуля
+
+# Основная клавиатура для пользователей
+MAIN_KEYBOARD = ReplyKeyboardMarkup([
+    ["💰 Мой баланс", "📊 История операций"],
+    ["➕ Добавить покупку", "🎁 Использовать баллы"],
+    ["👤 Мой профиль", "📋 Правила"],
+    ["🆘 Помощь"]
+], resize_keyboard=True)
+
+# Клавиатура для админов
+ADMIN_KEYBOARD = ReplyKeyboardMarkup([
+    ["📊 Статистика", "👥 Пользователи"],
+    ["➕ Добавить баллы", "✏️ Редактировать пользователя"],
+    ["📋 Экспорт данных", "⚙️ Настройки"],
+    ["🔙 В главное меню"]
+], resize_keyboard=True)
+
+# Клавиатура для отмены
+CANCEL_KEYBOARD = ReplyKeyboardMarkup([["❌ Отмена"]], resize_keyboard=True)
+
+# Клавиатуры регистрации
+CONTACT_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton(text="📱 Поделиться контактом", request_contact=True)]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+GENDER_KEYBOARD = ReplyKeyboardMarkup(
+    [["👨 Мужской", "👩 Женский"]],
+    resize_keyboard=True,
+    one_time_keyboard=True
+)
+REMOVE_KEYBOARD = ReplyKeyboardRemove()
 
+# Фильтры сообщений, общие для всех обработчиков
+TEXT_NO_CMD = filters.TEXT & ~filters.COMMAND
+PHONE_FILTER = filters.CONTACT | TEXT_NO_CMD
+ADD_PURCHASE_FILTER = filters.Text(["➕ Добавить покупку"])
+SPEND_POINTS_FILTER = filters.Text(["🎁 Использовать баллы"])
 
-def get_admin_keyboard():
-    """Клавиатура для админов"""
-    keyboard = [
-        ["📊 Статистика", "👥 Пользователи"],
-        ["➕ Добавить баллы", "✏️ Редактировать пользователя"],
-        ["📋 Экспорт данных", "⚙️ Настройки"],
-        ["🔙 В главное меню"]
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
 
+# ==================== QR КОДЫ ====================
+def render_qr_code(qr_code: str) -> bytes:
+    """Картинка с QR кодом в PNG, без записи на диск"""
+    buffer = io.BytesIO()
+    qrcode.make(qr_code).save(buffer, format='PNG')
+    return buffer.getvalue()
 
-def get_cancel_keyboard():
-    """Клавиатура для отмены"""
-    keyboard = [["❌ Отмена"]]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+async def send_qr_code(update: Update, user_info: dict):
+    """Отправка QR кода пользователю"""
+    # Картинка уже есть на серверах Telegram - отправляем без загрузки
+    if user_info.get('qr_file_id'):
+        try:
+            await update.message.reply_photo(photo=user_info['qr_file_id'])
+            return
+        except BadRequest as e:
+            # file_id привязан к токену бота: после смены токена загружаем заново
+            logger.warning(f"Сохранённый file_id QR кода недействителен: {e}")
+
+    photo = await asyncio.to_thread(render_qr_code, user_info['qr_code'])
+    message = await update.message.reply_photo(photo=photo)
+    # Картинка уже отправлена: ошибка сохранения file_id не должна
+    # приводить к повторной отправке кода текстом
+    try:
+        await db_write(db.set_qr_file_id, update.effective_user.id, message.photo[-1].file_id)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения file_id QR кода: {e}")
 
 
 # ==================== ОСНОВНЫЕ ФУНКЦИИ БОТА ====================
+@functools.lru_cache(maxsize=4096)
+def escape_md(value) -> str:
+    """Пользовательское поле (имя, телефон, пол) для вставки в Markdown-сообщение"""
+    return escape_markdown(str(value))
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало регистрации"""
     user = update.effective_user
@@ -587,33 +1046,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text(
             f"👑 Привет, администратор {user.first_name}!\n"
             f"Используйте /admin для доступа к панели управления",
-            reply_markup=get_admin_keyboard()
+            reply_markup=ADMIN_KEYBOARD
         )
         return ConversationHandler.END
 
     # Проверяем, зарегистрирован ли уже пользователь
-    user_info = db.get_user_info(user.id)
+    user_info = await get_user_info(user.id)
     if user_info:
         qr_text = f"📲 Ваш код для кассы:\n`{user_info['qr_code']}`" if user_info.get('qr_code') else ""
         await update.message.reply_text(
-            f"👋 Привет, {user_info['name']}!\n"
+            f"👋 Привет, {escape_md(user_info['name'])}!\n"
             f"Вы уже зарегистрированы.\n"
             f"Ваш баланс: {user_info['current_points']} баллов\n\n"
             f"{qr_text}\n\n"
             f"Используйте кнопки ниже:",
             parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
 
         # Отправляем QR код если он есть
         if user_info.get('qr_code'):
             try:
-                img = qrcode.make(user_info['qr_code'])
-                img_path = f"/tmp/qr_{user.id}.png"
-                img.save(img_path)
-                with open(img_path, 'rb') as photo:
-                    await update.message.reply_photo(photo=photo)
-                os.remove(img_path)
+                await send_qr_code(update, user_info)
             except Exception as e:
                 logger.error(f"Ошибка генерации QR: {e}")
                 await update.message.reply_text(
@@ -625,21 +1079,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         return ConversationHandler.END
 
     # Начинаем регистрацию
-    contact_button = KeyboardButton(
-        text="📱 Поделиться контактом",
-        request_contact=True
-    )
-    reply_markup = ReplyKeyboardMarkup(
-        [[contact_button]],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-
     await update.message.reply_text(
         f"👋 Привет, {user.first_name}!\n"
         f"Добро пожаловать в программу лояльности!\n\n"
         f"Для регистрации нажмите кнопку ниже:",
-        reply_markup=reply_markup
+        reply_markup=CONTACT_KEYBOARD
     )
     return PHONE
 
@@ -654,7 +1098,7 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     context.user_data['phone'] = phone_number
     await update.message.reply_text(
         "📝 Теперь напишите своё имя:",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KEYBOARD
     )
     return NAME
 
@@ -664,19 +1108,10 @@ async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     name = update.message.text
     context.user_data['name'] = name
 
-    gender_keyboard = [
-        ["👨 Мужской", "👩 Женский"]
-    ]
-    reply_markup = ReplyKeyboardMarkup(
-        gender_keyboard,
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-
     await update.message.reply_text(
         f"👋 Приятно познакомиться, {name}!\n"
         f"Теперь выберите ваш пол:",
-        reply_markup=reply_markup
+        reply_markup=GENDER_KEYBOARD
     )
     return GENDER
 
@@ -696,27 +1131,17 @@ async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     name = context.user_data.get('name')
     phone = context.user_data.get('phone')
 
-    user_id, qr_code = db.add_user(user.id, name, phone, gender)
-    user_info = db.get_user_info(user.id)
-
-    # Генерируем QR код
-    try:
-        img = qrcode.make(qr_code)
-        img_path = f"/tmp/qr_{user.id}.png"
-        img.save(img_path)
-    except Exception as e:
-        logger.error(f"Ошибка генерации QR: {e}")
-        img_path = None
+    user_info = await db_write(db.add_user, user.id, name, phone, gender)
 
     registration_message = (
         "✅ *Регистрация завершена!*\n\n"
         f"*Ваши данные:*\n"
-        f"👤 Имя: {user_info['name']}\n"
-        f"📱 Телефон: {user_info['phone']}\n"
-        f"⚤ Пол: {user_info['gender']}\n"
-        f"🎁 Бонус за регистрацию: {LOYALTY_SETTINGS['welcome_bonus']} баллов\n"
+        f"👤 Имя: {escape_md(user_info['name'])}\n"
+        f"📱 Телефон: {escape_md(user_info['phone'])}\n"
+        f"⚤ Пол: {escape_md(user_info['gender'])}\n"
+        f"🎁 Бонус за регистрацию: {WELCOME_BONUS} баллов\n"
         f"💰 Текущий баланс: {user_info['current_points']} баллов\n"
-        f"📲 Ваш код для кассы:\n`{qr_code}`\n\n"
+        f"📲 Ваш код для кассы:\n`{user_info['qr_code']}`\n\n"
         f"*Как использовать:*\n"
         f"1. Покажите QR код на кассе\n"
         f"2. Получайте баллы за покупки\n"
@@ -727,192 +1152,219 @@ async def get_gender(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await update.message.reply_text(
         registration_message,
         parse_mode='Markdown',
-        reply_markup=get_main_keyboard()
+        reply_markup=MAIN_KEYBOARD
     )
 
     # Отправляем QR код
-    if img_path and os.path.exists(img_path):
-        with open(img_path, 'rb') as photo:
-            await update.message.reply_photo(photo=photo)
-        os.remove(img_path)
+    try:
+        await send_qr_code(update, user_info)
+    except Exception as e:
+        logger.error(f"Ошибка генерации QR: {e}")
 
     return ConversationHandler.END
 
 
 # ==================== ОБРАБОТКА КНОПОК ====================
-async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка нажатий кнопок"""
-    user = update.effective_user
-    text = update.message.text
-    user_info = db.get_user_info(user.id)
-
-    if text == "💰 Мой баланс":
+def format_timestamp(timestamp) -> str:
+    """'ГГГГ-ММ-ДД ЧЧ:ММ:СС' из SQLite -> 'ДД.ММ.ГГГГ ЧЧ:ММ'"""
+    # Формат SQLite фиксирован, поэтому хватает срезов строки без datetime
+    if isinstance(timestamp, str) and len(timestamp) >= 16:
+        return f"{timestamp[8:10]}.{timestamp[5:7]}.{timestamp[:4]} {timestamp[11:16]}"
+    return str(timestamp)
+
+
+def require_registered(handler):
+    """Передаёт в обработчик user_info, незарегистрированным отвечает отказом"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_info = await get_user_info(update.effective_user.id)
         if not user_info:
             await update.message.reply_text(
                 "❌ Вы не зарегистрированы. Используйте /start",
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
             return
+        return await handler(update, context, user_info)
 
-        await update.message.reply_text(
-            f"💰 *Ваш баланс:* {user_info['current_points']} баллов\n"
-            f"🎯 *Доступная скидка:* {user_info['current_points'] * LOYALTY_SETTINGS['discount_per_point']:.1f}%\n"
-            f"📊 *Всего накоплено:* {user_info['total_points']} баллов\n"
-            f"🛒 *Сумма покупок:* {user_info['total_purchases']:.2f} руб.\n\n"
-            f"*QR код:* `{user_info['qr_code']}`",
-            parse_mode='Markdown',
-            reply_markup=get_main_keyboard()
-        )
+    return wrapper
 
-    elif text == "📊 История операций":
-        if not user_info:
-            await update.message.reply_text(
-                "❌ Вы не зарегистрированы. Используйте /start",
-                reply_markup=get_main_keyboard()
-            )
-            return
 
-        transactions = db.get_user_transactions(user_info['user_id'], limit=5)
-        if not transactions:
-            history_message = "📜 *История операций:*\n\nОпераций пока нет"
-        else:
-            history_message = "📜 *Последние операции:*\n\n"
-            for trans in transactions:
-                try:
-                    date_str = datetime.strptime(trans['timestamp'], '%Y-%m-%d %H:%M:%S').strftime('%d.%m.%Y %H:%M')
-                except:
-                    date_str = str(trans['timestamp'])
-                points = trans['points_change']
-                points_str = f"+{points}" if points > 0 else str(points)
-                history_message += f"• {date_str}: {trans['description']} ({points_str} баллов)\n"
+@require_registered
+async def _show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, user_info: dict):
+    """Баланс пользователя"""
+    await update.message.reply_text(
+        f"💰 *Ваш баланс:* {user_info['current_points']} баллов\n"
+        f"🎯 *Доступная скидка:* {user_info['current_points'] * DISCOUNT_PER_POINT:.1f}%\n"
+        f"📊 *Всего накоплено:* {user_info['total_points']} баллов\n"
+        f"🛒 *Сумма покупок:* {user_info['total_purchases']:.2f} руб.\n\n"
+        f"*QR код:* `{user_info['qr_code']}`",
+        parse_mode='Markdown',
+        reply_markup=MAIN_KEYBOARD
+    )
 
-        await update.message.reply_text(
-            history_message,
-            parse_mode='Markdown',
-            reply_markup=get_main_keyboard()
-        )
 
-    elif text == "➕ Добавить покупку":
-        if not user_info:
-            await update.message.reply_text(
-                "❌ Вы не зарегистрированы. Используйте /start",
-                reply_markup=get_main_keyboard()
-            )
-            return
+@require_registered
+async def _show_history(update: Update, context: ContextTypes.DEFAULT_TYPE, user_info: dict):
+    """Последние операции пользователя"""
+    transactions = await db_read(db.get_user_transactions, user_info['user_id'], 5)
+    if not transactions:
+        history_message = "📜 *История операций:*\n\nОпераций пока нет"
+    else:
+        history_message = "📜 *Последние операции:*\n\n"
+        for trans in transactions:
+            date_str = format_timestamp(trans['timestamp'])
+            points = trans['points_change']
+            points_str = f"+{points}" if points > 0 else str(points)
+            history_message += f"• {date_str}: {trans['description']} ({points_str} баллов)\n"
 
-        await update.message.reply_text(
-            "💵 Введите сумму покупки в рублях (например: 1500.50):",
-            reply_markup=get_cancel_keyboard()
-        )
-        return ADD_PURCHASE
+    await update.message.reply_text(
+        history_message,
+        parse_mode='Markdown',
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    elif text == "🎁 Использовать баллы":
-        if not user_info:
-            await update.message.reply_text(
-                "❌ Вы не зарегистрированы. Используйте /start",
-                reply_markup=get_main_keyboard()
-            )
-            return
 
-        await update.message.reply_text(
-            f"🎁 Ваш текущий баланс: {user_info['current_points']} баллов\n"
-            f"Максимальная скидка: {LOYALTY_SETTINGS['max_discount']}%\n"
-            f"Введите количество баллов для использования:",
-            reply_markup=get_cancel_keyboard()
-        )
-        return SPEND_POINTS
+@require_registered
+async def _start_add_purchase(update: Update, context: ContextTypes.DEFAULT_TYPE, user_info: dict):
+    """Начало добавления покупки"""
+    await update.message.reply_text(
+        "💵 Введите сумму покупки в рублях (например: 1500.50):",
+        reply_markup=CANCEL_KEYBOARD
+    )
+    return ADD_PURCHASE
 
-    elif text == "👤 Мой профиль":
-        if not user_info:
-            await update.message.reply_text(
-                "❌ Вы не зарегистрированы. Используйте /start",
-                reply_markup=get_main_keyboard()
-            )
-            return
 
-        registration_date = user_info['registration_date']
-        if isinstance(registration_date, str):
-            date_str = registration_date.split()[0] if ' ' in registration_date else registration_date
-        else:
-            date_str = "Неизвестно"
+@require_registered
+async def _start_spend_points(update: Update, context: ContextTypes.DEFAULT_TYPE, user_info: dict):
+    """Начало списания баллов"""
+    await update.message.reply_text(
+        f"🎁 Ваш текущий баланс: {user_info['current_points']} баллов\n"
+        f"Максимальная скидка: {MAX_DISCOUNT}%\n"
+        f"Введите количество баллов для использования:",
+        reply_markup=CANCEL_KEYBOARD
+    )
+    return SPEND_POINTS
 
-        qr_text = f"📱 QR код: `{user_info['qr_code']}`" if user_info.get('qr_code') else ""
 
-        profile_message = (
-            "👤 *Ваш профиль:*\n\n"
-            f"📛 Имя: {user_info['name']}\n"
-            f"📱 Телефон: {user_info['phone']}\n"
-            f"⚤ Пол: {user_info.get('gender', 'Не указан')}\n"
-            f"📅 Дата регистрации: {date_str}\n"
-            f"{qr_text}\n\n"
-            f"💰 *Статистика:*\n"
-            f"• Текущий баланс: {user_info['current_points']} баллов\n"
-            f"• Всего накоплено: {user_info['total_points']} баллов\n"
-            f"• Общая сумма покупок: {user_info['total_purchases']:.2f} руб.\n"
-            f"• Доступная скидка: {user_info['current_points'] * LOYALTY_SETTINGS['discount_per_point']:.1f}%\n"
-            f"• Максимальная скидка: {LOYALTY_SETTINGS['max_discount']}%"
-        )
+# Текст профиля зависит только от полей пользователя: повторный показ
+# с теми же данными берётся из кэша, новые баланс или покупки дают новый ключ
+@functools.lru_cache(maxsize=4096)
+def _render_profile(name, phone, gender, registration_date, qr_code,
+                    current_points: int, total_points: int, total_purchases: float) -> str:
+    """Текст профиля пользователя с экранированием Markdown"""
+    if isinstance(registration_date, str):
+        date_str = registration_date.split()[0] if ' ' in registration_date else registration_date
+    else:
+        date_str = "Неизвестно"
+
+    qr_text = f"📱 QR код: `{qr_code}`" if qr_code else ""
+
+    return (
+        "👤 *Ваш профиль:*\n\n"
+        f"📛 Имя: {escape_md(name)}\n"
+        f"📱 Телефон: {escape_md(phone)}\n"
+        f"⚤ Пол: {escape_md(gender)}\n"
+        f"📅 Дата регистрации: {date_str}\n"
+        f"{qr_text}\n\n"
+        f"💰 *Статистика:*\n"
+        f"• Текущий баланс: {current_points} баллов\n"
+        f"• Всего накоплено: {total_points} баллов\n"
+        f"• Общая сумма покупок: {total_purchases:.2f} руб.\n"
+        f"• Доступная скидка: {current_points * DISCOUNT_PER_POINT:.1f}%\n"
+        f"• Максимальная скидка: {MAX_DISCOUNT}%"
+    )
 
-        await update.message.reply_text(
-            profile_message,
-            parse_mode='Markdown',
-            reply_markup=get_main_keyboard()
-        )
 
-    elif text == "📋 Правила":
-        rules_message = (
-            "📋 *Правила программы лояльности:*\n\n"
-            f"🎁 *Начисление баллов:*\n"
-            f"• За каждый рубль покупки: {LOYALTY_SETTINGS['points_per_purchase'] * 100}% от суммы\n"
-            f"• Бонус за регистрацию: {LOYALTY_SETTINGS['welcome_bonus']} баллов\n\n"
-            f"💰 *Использование баллов:*\n"
-            f"• 1 балл = {LOYALTY_SETTINGS['discount_per_point'] * 100}% скидки\n"
-            f"• Максимальная скидка: {LOYALTY_SETTINGS['max_discount']}%\n"
-            f"• Баллы не имеют срока действия\n\n"
-            f"📱 *Как использовать:*\n"
-            f"1. Покажите QR код на кассе для начисления баллов\n"
-            f"2. Добавляйте покупки через кнопку '➕ Добавить покупку'\n"
-            f"3. Копите баллы\n"
-            f"4. Используйте баллы через кнопку '🎁 Использовать баллы'"
-        )
+@require_registered
+async def _show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, user_info: dict):
+    """Профиль пользователя"""
+    profile_message = _render_profile(
+        user_info['name'], user_info['phone'], user_info.get('gender', 'Не указан'),
+        user_info['registration_date'], user_info.get('qr_code'),
+        user_info['current_points'], user_info['total_points'], user_info['total_purchases']
+    )
 
-        await update.message.reply_text(
-            rules_message,
-            parse_mode='Markdown',
-            reply_markup=get_main_keyboard()
-        )
+    await update.message.reply_text(
+        profile_message,
+        parse_mode='Markdown',
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    elif text == "🆘 Помощь":
-        help_message = (
-            "🆘 *Помощь по боту:*\n\n"
-            "📋 *Основные функции:*\n"
-            "• 💰 Мой баланс - просмотр баланса баллов\n"
-            "• 📊 История операций - последние транзакции\n"
-            "• ➕ Добавить покупку - добавить новую покупку\n"
-            "• 🎁 Использовать баллы - потратить баллы на скидку\n"
-            "• 👤 Мой профиль - ваши данные\n"
-            "• 📋 Правила - правила программы\n\n"
-            "👑 *Для администраторов:*\n"
-            "Используйте /admin для доступа к панели управления\n\n"
-            f"📞 *Поддержка:*\n"
-            f"Сервер: {WEBHOOK_URL}"
-        )
 
-        await update.message.reply_text(
-            help_message,
-            parse_mode='Markdown',
-            reply_markup=get_main_keyboard()
-        )
+async def _show_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Правила программы лояльности"""
+    await update.message.reply_text(
+        RULES_MESSAGE,
+        parse_mode='Markdown',
+        reply_markup=MAIN_KEYBOARD
+    )
 
-    elif text == "❌ Отмена":
-        await update.message.reply_text(
-            "❌ Действие отменено.",
-            reply_markup=get_main_keyboard()
-        )
-        return ConversationHandler.END
+
+async def _show_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Справка по боту"""
+    await update.message.reply_text(
+        HELP_MESSAGE,
+        parse_mode='Markdown',
+        reply_markup=MAIN_KEYBOARD
+    )
+
+
+async def _cancel_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отмена действия"""
+    await update.message.reply_text(
+        "❌ Действие отменено.",
+        reply_markup=MAIN_KEYBOARD
+    )
+    return ConversationHandler.END
+
+
+# Кнопка -> обработчик: один поиск в словаре вместо цепочки сравнений
+BUTTON_HANDLERS = {
+    "💰 Мой баланс": _show_balance,
+    "📊 История операций": _show_history,
+    "➕ Добавить покупку": _start_add_purchase,
+    "🎁 Использовать баллы": _start_spend_points,
+    "👤 Мой профиль": _show_profile,
+    "📋 Правила": _show_rules,
+    "🆘 Помощь": _show_help,
+    "❌ Отмена": _cancel_action,
+}
+
+
+async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка нажатий кнопок"""
+    handler = BUTTON_HANDLERS.get(update.message.text)
+    if handler is None:
+        return
+    return await handler(update, context)
 
 
 # ==================== ОБРАБОТКА ПОКУПОК И БАЛЛОВ ====================
+# Ввод проверяется регулярными выражениями, без исключений на каждую ошибку.
+# Число цифр ограничено: слишком длинный ввод дал бы inf или число,
+# не влезающее в INTEGER SQLite
+_AMOUNT_RE = re.compile(r'^\s*(\d{1,9}(?:[.,]\d{1,2})?)\s*$')
+_INT_RE = re.compile(r'^\s*(\d{1,9})\s*$')
+
+
+def _parse_amount(text: str) -> Optional[float]:
+    """Сумма в рублях (до копеек) или None, если ввод некорректен"""
+    match = _AMOUNT_RE.match(text)
+    if not match:
+        return None
+    amount = float(match.group(1).replace(',', '.'))
+    return amount if amount > 0 else None
+
+
+def _parse_points(text: str) -> Optional[int]:
+    """Положительное целое количество баллов или None"""
+    match = _INT_RE.match(text)
+    if not match:
+        return None
+    points = int(match.group(1))
+    return points if points > 0 else None
+
+
 async def add_purchase_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка добавления покупки"""
     user = update.effective_user
@@ -921,39 +1373,42 @@ async def add_purchase_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     if text == "❌ Отмена":
         await update.message.reply_text(
             "❌ Добавление покупки отменено.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
         return ConversationHandler.END
 
-    try:
-        amount = float(text)
-        if amount <= 0:
-            raise ValueError
-
-        user_info = db.get_user_info(user.id)
-        points_earned, new_balance = db.add_purchase(user_info['user_id'], amount)
-
-        response = (
-            f"✅ *Покупка зарегистрирована!*\n\n"
-            f"💵 Сумма покупки: {amount:.2f} руб.\n"
-            f"🎁 Начислено баллов: {points_earned}\n"
-            f"💰 Новый баланс: {new_balance} баллов\n"
-            f"🎯 Доступная скидка: {new_balance * LOYALTY_SETTINGS['discount_per_point']:.1f}%"
+    amount = _parse_amount(text)
+    if amount is None:
+        await update.message.reply_text(
+            "❌ Неверный формат суммы. Введите число (например: 1500.50):",
+            reply_markup=CANCEL_KEYBOARD
         )
+        return ADD_PURCHASE
 
+    result = await db_write(db.add_purchase, user.id, amount)
+    if result is None:
         await update.message.reply_text(
-            response,
-            parse_mode='Markdown',
-            reply_markup=get_main_keyboard()
+            "❌ Вы не зарегистрированы. Используйте /start",
+            reply_markup=MAIN_KEYBOARD
         )
         return ConversationHandler.END
 
-    except ValueError:
-        await update.message.reply_text(
-            "❌ Неверный формат суммы. Введите число (например: 1500.50):",
-            reply_markup=get_cancel_keyboard()
-        )
-        return ADD_PURCHASE
+    points_earned, new_balance = result
+
+    response = (
+        f"✅ *Покупка зарегистрирована!*\n\n"
+        f"💵 Сумма покупки: {amount:.2f} руб.\n"
+        f"🎁 Начислено баллов: {points_earned}\n"
+        f"💰 Новый баланс: {new_balance} баллов\n"
+        f"🎯 Доступная скидка: {new_balance * DISCOUNT_PER_POINT:.1f}%"
+    )
+
+    await update.message.reply_text(
+        response,
+        parse_mode='Markdown',
+        reply_markup=MAIN_KEYBOARD
+    )
+    return ConversationHandler.END
 
 
 async def spend_points_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -964,40 +1419,35 @@ async def spend_points_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     if text == "❌ Отмена":
         await update.message.reply_text(
             "❌ Использование баллов отменено.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
         return ConversationHandler.END
 
-    try:
-        points_to_spend = int(text)
-        if points_to_spend <= 0:
-            raise ValueError
-
-        user_info = db.get_user_info(user.id)
-        if points_to_spend > user_info['current_points']:
-            await update.message.reply_text(
-                f"❌ Недостаточно баллов. Ваш баланс: {user_info['current_points']}\n"
-                f"Введите меньшее количество:",
-                reply_markup=get_cancel_keyboard()
-            )
-            return SPEND_POINTS
-
-        context.user_data['points_to_spend'] = points_to_spend
-        context.user_data['user_id'] = user_info['user_id']
-
+    points_to_spend = _parse_points(text)
+    if points_to_spend is None:
         await update.message.reply_text(
-            "💵 Введите сумму покупки в рублях для расчета скидки:",
-            reply_markup=get_cancel_keyboard()
+            "❌ Неверный формат. Введите целое число баллов:",
+            reply_markup=CANCEL_KEYBOARD
         )
-        return CHECK_BALANCE
+        return SPEND_POINTS
 
-    except ValueError:
+    user_info = await get_user_info(user.id)
+    if points_to_spend > user_info['current_points']:
         await update.message.reply_text(
-            "❌ Неверный формат. Введите целое число баллов:",
-            reply_markup=get_cancel_keyboard()
+            f"❌ Недостаточно баллов. Ваш баланс: {user_info['current_points']}\n"
+            f"Введите меньшее количество:",
+            reply_markup=CANCEL_KEYBOARD
         )
         return SPEND_POINTS
 
+    context.user_data['points_to_spend'] = points_to_spend
+
+    await update.message.reply_text(
+        "💵 Введите сумму покупки в рублях для расчета скидки:",
+        reply_markup=CANCEL_KEYBOARD
+    )
+    return CHECK_BALANCE
+
 
 async def calculate_discount_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Расчет скидки"""
@@ -1006,55 +1456,50 @@ async def calculate_discount_handler(update: Update, context: ContextTypes.DEFAU
     if text == "❌ Отмена":
         await update.message.reply_text(
             "❌ Использование баллов отменено.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
         return ConversationHandler.END
 
-    try:
-        purchase_amount = float(text)
-        if purchase_amount <= 0:
-            raise ValueError
-
-        points_to_spend = context.user_data.get('points_to_spend')
-        user_id = context.user_data.get('user_id')
-
-        success, new_balance, discount = db.spend_points(
-            user_id, points_to_spend, purchase_amount
+    purchase_amount = _parse_amount(text)
+    if purchase_amount is None:
+        await update.message.reply_text(
+            "❌ Неверный формат суммы. Введите число (например: 1500.50):",
+            reply_markup=CANCEL_KEYBOARD
         )
+        return CHECK_BALANCE
 
-        if success:
-            discount_amount = purchase_amount * discount / 100
-            final_amount = purchase_amount - discount_amount
-
-            response = (
-                f"✅ *Баллы успешно списаны!*\n\n"
-                f"🎁 Списано баллов: {points_to_spend}\n"
-                f"📉 Скидка: {discount:.1f}% ({discount_amount:.2f} руб.)\n"
-                f"💰 К оплате: {final_amount:.2f} руб.\n"
-                f"💳 Изначальная сумма: {purchase_amount:.2f} руб.\n"
-                f"📊 Новый баланс: {new_balance} баллов\n\n"
-                f"💡 *Совет:* Покажите это сообщение кассиру для применения скидки"
-            )
+    points_to_spend = context.user_data.get('points_to_spend')
 
-            await update.message.reply_text(
-                response,
-                parse_mode='Markdown',
-                reply_markup=get_main_keyboard()
-            )
-        else:
-            await update.message.reply_text(
-                "❌ Ошибка при списании баллов.",
-                reply_markup=get_main_keyboard()
-            )
+    success, new_balance, discount = await db_write(
+        db.spend_points, update.effective_user.id, points_to_spend, purchase_amount
+    )
 
-        return ConversationHandler.END
+    if success:
+        discount_amount = purchase_amount * discount / 100
+        final_amount = purchase_amount - discount_amount
+
+        response = (
+            f"✅ *Баллы успешно списаны!*\n\n"
+            f"🎁 Списано баллов: {points_to_spend}\n"
+            f"📉 Скидка: {discount:.1f}% ({discount_amount:.2f} руб.)\n"
+            f"💰 К оплате: {final_amount:.2f} руб.\n"
+            f"💳 Изначальная сумма: {purchase_amount:.2f} руб.\n"
+            f"📊 Новый баланс: {new_balance} баллов\n\n"
+            f"💡 *Совет:* Покажите это сообщение кассиру для применения скидки"
+        )
 
-    except ValueError:
         await update.message.reply_text(
-            "❌ Неверный формат суммы. Введите число (например: 1500.50):",
-            reply_markup=get_cancel_keyboard()
+            response,
+            parse_mode='Markdown',
+            reply_markup=MAIN_KEYBOARD
+        )
+    else:
+        await update.message.reply_text(
+            "❌ Ошибка при списании баллов.",
+            reply_markup=MAIN_KEYBOARD
         )
-        return CHECK_BALANCE
+
+    return ConversationHandler.END
 
 
 # ==================== АДМИН ПАНЕЛЬ ====================
@@ -1065,155 +1510,223 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id not in ADMINS:
         await update.message.reply_text(
             "❌ Доступ только для администраторов!",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
         return
 
     await update.message.reply_text(
         f"👑 *Панель администратора*\n"
-        f"Добро пожаловать, {user.first_name}!\n\n"
+        f"Добро пожаловать, {escape_md(user.first_name)}!\n\n"
         f"Сервер: {WEBHOOK_URL}\n"
         f"База данных: {DB_NAME}\n\n"
         f"Выберите действие:",
         parse_mode='Markdown',
-        reply_markup=get_admin_keyboard()
+        reply_markup=ADMIN_KEYBOARD
     )
     return ADMIN_MENU
 
 
-async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка кнопок админ панели"""
-    user = update.effective_user
-    text = update.message.text
+async def _admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Статистика системы"""
+    stats = await get_system_stats()
+    stats_message = (
+        "📊 *Статистика системы:*\n\n"
+        f"👥 Пользователей: {stats['total_users']}\n"
+        f"💰 Общий оборот: {stats['total_sales']:.2f} руб.\n"
+        f"🎁 Всего баллов в системе: {stats['total_points']}\n"
+        f"📈 Средний чек: {stats['avg_purchase']:.2f} руб.\n\n"
+        f"⚙️ *Настройки:*\n"
+        f"• Баллов за рубль: {POINTS_PER_PURCHASE_PCT}%\n"
+        f"• Скидка за балл: {DISCOUNT_PER_POINT_PCT}%\n"
+        f"• Макс. скидка: {MAX_DISCOUNT}%\n"
+        f"• Бонус за регистрацию: {WELCOME_BONUS}\n\n"
+        f"🌐 *Сервер:*\n"
+        f"• URL: {WEBHOOK_URL}\n"
+        f"• Webhook: {WEBHOOK_URL}/evotor/webhook\n"
+        f"• База данных: {DB_NAME}"
+    )
 
-    if user.id not in ADMINS:
-        await update.message.reply_text(
-            "❌ Доступ только для администраторов!",
-            reply_markup=get_main_keyboard()
-        )
-        return ConversationHandler.END
+    await update.message.reply_text(
+        stats_message,
+        parse_mode='Markdown',
+        reply_markup=ADMIN_KEYBOARD
+    )
 
-    if text == "📊 Статистика":
-        stats = db.get_system_stats()
-        stats_message = (
-            "📊 *Статистика системы:*\n\n"
-            f"👥 Пользователей: {stats['total_users']}\n"
-            f"💰 Общий оборот: {stats['total_sales']:.2f} руб.\n"
-            f"🎁 Всего баллов в системе: {stats['total_points']}\n"
-            f"📈 Средний чек: {stats['avg_purchase']:.2f} руб.\n\n"
-            f"⚙️ *Настройки:*\n"
-            f"• Баллов за рубль: {LOYALTY_SETTINGS['points_per_purchase'] * 100}%\n"
-            f"• Скидка за балл: {LOYALTY_SETTINGS['discount_per_point'] * 100}%\n"
-            f"• Макс. скидка: {LOYALTY_SETTINGS['max_discount']}%\n"
-            f"• Бонус за регистрацию: {LOYALTY_SETTINGS['welcome_bonus']}\n\n"
-            f"🌐 *Сервер:*\n"
-            f"• URL: {WEBHOOK_URL}\n"
-            f"• Webhook: {WEBHOOK_URL}/evotor/webhook\n"
-            f"• База данных: {DB_NAME}"
-        )
 
-        await update.message.reply_text(
-            stats_message,
-            parse_mode='Markdown',
-            reply_markup=get_admin_keyboard()
-        )
+# Пользователей в списке админа показываем страницами
+USERS_PAGE_SIZE = 10
 
-    elif text == "👥 Пользователи":
-        users, total = db.get_all_users(limit=10)
-        if not users:
-            message = "📭 *Пользователей пока нет*"
-        else:
-            message = f"👥 *Пользователи (всего: {total}):*\n\n"
-            for i, user_data in enumerate(users, start=1):
-                reg_date = user_data['registration_date']
-                date_str = reg_date.split()[0] if reg_date and ' ' in reg_date else reg_date or "Неизвестно"
-                qr_text = f" | 📱 {user_data['qr_code']}" if user_data.get('qr_code') else ""
-                message += (
-                    f"{i}. *{user_data['name']}*\n"
-                    f"   🆔 ID: {user_data['user_id']}\n"
-                    f"   📱 {user_data['phone']}{qr_text}\n"
-                    f"   💰 {user_data['current_points']} баллов\n"
-                    f"   🛒 {user_data['total_purchases']:.2f} руб.\n"
-                    f"   📅 {date_str}\n\n"
-                )
 
-        await update.message.reply_text(
-            message,
-            parse_mode='Markdown',
-            reply_markup=get_admin_keyboard()
-        )
+def _format_user_entry(i: int, user_data: dict) -> str:
+    """Строка списка пользователей"""
+    reg_date = user_data['registration_date']
+    date_str = reg_date.split()[0] if reg_date and ' ' in reg_date else reg_date or "Неизвестно"
+    qr_text = f" | 📱 {user_data['qr_code']}" if user_data.get('qr_code') else ""
+    return (
+        f"{i}. *{escape_md(user_data['name'])}*\n"
+        f"   🆔 ID: {user_data['user_id']}\n"
+        f"   📱 {escape_md(user_data['phone'])}{qr_text}\n"
+        f"   💰 {user_data['current_points']} баллов\n"
+        f"   🛒 {user_data['total_purchases']:.2f} руб.\n"
+        f"   📅 {date_str}\n\n"
+    )
 
-    elif text == "➕ Добавить баллы":
-        await update.message.reply_text(
-            "🎁 Введите ID пользователя и количество баллов через пробел:\n\n"
-            "Пример: `1 500` - добавит 500 баллов пользователю с ID 1\n"
-            "Пример: `1 -100` - вычтет 100 баллов",
-            parse_mode='Markdown',
-            reply_markup=get_cancel_keyboard()
-        )
-        return ADMIN_ADD_USER
 
-    elif text == "✏️ Редактировать пользователя":
-        await update.message.reply_text(
-            "✏️ Введите ID пользователя для редактирования:",
-            reply_markup=get_cancel_keyboard()
-        )
-        return ADMIN_EDIT_USER
+async def _users_page(offset: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    """Текст страницы списка пользователей и кнопки перехода между страницами"""
+    # Страница и число пользователей читаются параллельно; число берётся
+    # из счётчиков статистики вместо COUNT(*) по всей таблице
+    users, stats = await asyncio.gather(
+        db_read(db.get_users_page, USERS_PAGE_SIZE, offset),
+        db_read(db.get_system_stats)
+    )
+    total = stats['total_users']
+    if not users:
+        return "📭 *Пользователей пока нет*", None
 
-    elif text == "📋 Экспорт данных":
-        stats = db.get_system_stats()
-        export_text = (
-            f"Экспорт данных системы лояльности\n"
-            f"Дата: {datetime.now().strftime('%Y-%m-%d %H:%M')}\n\n"
-            f"📊 Статистика:\n"
-            f"- Пользователей: {stats['total_users']}\n"
-            f"- Общий оборот: {stats['total_sales']:.2f} руб.\n"
-            f"- Всего баллов: {stats['total_points']}\n"
-            f"- Средний чек: {stats['avg_purchase']:.2f} руб.\n\n"
-            f"⚙️ Настройки:\n"
-            f"- Баллов за рубль: {LOYALTY_SETTINGS['points_per_purchase'] * 100}%\n"
-            f"- Скидка за балл: {LOYALTY_SETTINGS['discount_per_point'] * 100}%\n"
-            f"- Макс. скидка: {LOYALTY_SETTINGS['max_discount']}%\n"
-            f"- Бонус за регистрацию: {LOYALTY_SETTINGS['welcome_bonus']}\n\n"
-            f"🌐 Сервер: {WEBHOOK_URL}"
-        )
+    # Собираем сообщение одним join вместо конкатенации в цикле
+    parts = [f"👥 *Пользователи (всего: {total}):*\n\n"]
+    parts.extend(_format_user_entry(i, user_data) for i, user_data in enumerate(users, start=offset + 1))
 
-        await update.message.reply_text(
-            f"<pre>{export_text}</pre>",
-            parse_mode='HTML',
-            reply_markup=get_admin_keyboard()
-        )
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"users:{max(0, offset - USERS_PAGE_SIZE)}"))
+    if offset + USERS_PAGE_SIZE < total:
+        buttons.append(InlineKeyboardButton("Вперёд ➡️", callback_data=f"users:{offset + USERS_PAGE_SIZE}"))
 
-    elif text == "⚙️ Настройки":
-        settings_message = (
-            "⚙️ *Настройки системы:*\n\n"
-            f"🎯 *Текущие настройки:*\n"
-            f"• Баллов за рубль: {LOYALTY_SETTINGS['points_per_purchase'] * 100}%\n"
-            f"• Скидка за балл: {LOYALTY_SETTINGS['discount_per_point'] * 100}%\n"
-            f"• Макс. скидка: {LOYALTY_SETTINGS['max_discount']}%\n"
-            f"• Бонус за регистрацию: {LOYALTY_SETTINGS['welcome_bonus']}\n"
-            f"• Бонус на день рождения: {LOYALTY_SETTINGS['birthday_bonus']}\n\n"
-            f"⚠️ Для изменения настроек требуется редактирование кода.\n\n"
-            f"📊 *Техническая информация:*\n"
-            f"• Бот токен: {'Установлен' if BOT_TOKEN else 'Не установлен'}\n"
-            f"• Админ ID: {YOUR_TELEGRAM_ID}\n"
-            f"• База данных: {DB_NAME}\n"
-            f"• Вебхук URL: {WEBHOOK_URL}/evotor/webhook"
-        )
+    return "".join(parts), InlineKeyboardMarkup([buttons]) if buttons else None
 
-        await update.message.reply_text(
-            settings_message,
-            parse_mode='Markdown',
-            reply_markup=get_admin_keyboard()
-        )
 
-    elif text == "🔙 В главное меню":
+async def _admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Список пользователей"""
+    message, pages_keyboard = await _users_page(0)
+    await update.message.reply_text(
+        message,
+        parse_mode='Markdown',
+        reply_markup=pages_keyboard or ADMIN_KEYBOARD
+    )
+
+
+async def admin_users_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переход по страницам списка пользователей"""
+    query = update.callback_query
+    if query.from_user.id not in ADMINS:
+        await query.answer("❌ Доступ только для администраторов!")
+        return
+
+    await query.answer()
+    message, pages_keyboard = await _users_page(int(query.data.split(':', 1)[1]))
+    await query.edit_message_text(
+        message,
+        parse_mode='Markdown',
+        reply_markup=pages_keyboard
+    )
+
+
+async def _admin_start_add_points(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало изменения баланса пользователя"""
+    await update.message.reply_text(
+        "🎁 Введите ID пользователя и количество баллов через пробел:\n\n"
+        "Пример: `1 500` - добавит 500 баллов пользователю с ID 1\n"
+        "Пример: `1 -100` - вычтет 100 баллов",
+        parse_mode='Markdown',
+        reply_markup=CANCEL_KEYBOARD
+    )
+    return ADMIN_ADD_USER
+
+
+async def _admin_start_edit_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Начало редактирования пользователя"""
+    await update.message.reply_text(
+        "✏️ Введите ID пользователя для редактирования:",
+        reply_markup=CANCEL_KEYBOARD
+    )
+    return ADMIN_EDIT_USER
+
+
+# Текущая минута в виде строки, пересчитывается раз в минуту
+_minute_cache: Tuple[int, str] = (0, "")
+
+
+def now_minute_str() -> str:
+    """Текущие дата и время с точностью до минуты: 'ГГГГ-ММ-ДД ЧЧ:ММ'"""
+    global _minute_cache
+    minute = int(time.time()) // 60
+    if minute != _minute_cache[0]:
+        _minute_cache = (minute, datetime.now().strftime('%Y-%m-%d %H:%M'))
+    return _minute_cache[1]
+
+
+async def _admin_export(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Экспорт данных системы"""
+    stats = await get_system_stats()
+    export_text = (
+        f"Экспорт данных системы лояльности\n"
+        f"Дата: {now_minute_str()}\n\n"
+        f"📊 Статистика:\n"
+        f"- Пользователей: {stats['total_users']}\n"
+        f"- Общий оборот: {stats['total_sales']:.2f} руб.\n"
+        f"- Всего баллов: {stats['total_points']}\n"
+        f"- Средний чек: {stats['avg_purchase']:.2f} руб.\n\n"
+        f"⚙️ Настройки:\n"
+        f"- Баллов за рубль: {POINTS_PER_PURCHASE_PCT}%\n"
+        f"- Скидка за балл: {DISCOUNT_PER_POINT_PCT}%\n"
+        f"- Макс. скидка: {MAX_DISCOUNT}%\n"
+        f"- Бонус за регистрацию: {WELCOME_BONUS}\n\n"
+        f"🌐 Сервер: {WEBHOOK_URL}"
+    )
+
+    await update.message.reply_text(
+        f"<pre>{export_text}</pre>",
+        parse_mode='HTML',
+        reply_markup=ADMIN_KEYBOARD
+    )
+
+
+async def _admin_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Настройки системы"""
+    await update.message.reply_text(
+        SETTINGS_MESSAGE,
+        parse_mode='Markdown',
+        reply_markup=ADMIN_KEYBOARD
+    )
+
+
+async def _admin_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Возврат в главное меню"""
+    await update.message.reply_text(
+        "🔙 Возврат в главное меню...",
+        reply_markup=MAIN_KEYBOARD
+    )
+    return ConversationHandler.END
+
+
+# Кнопка админ панели -> обработчик
+ADMIN_HANDLERS = {
+    "📊 Статистика": _admin_stats,
+    "👥 Пользователи": _admin_users,
+    "➕ Добавить баллы": _admin_start_add_points,
+    "✏️ Редактировать пользователя": _admin_start_edit_user,
+    "📋 Экспорт данных": _admin_export,
+    "⚙️ Настройки": _admin_settings,
+    "🔙 В главное меню": _admin_main_menu,
+}
+
+
+async def handle_admin_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка кнопок админ панели"""
+    if update.effective_user.id not in ADMINS:
         await update.message.reply_text(
-            "🔙 Возврат в главное меню...",
-            reply_markup=get_main_keyboard()
+            "❌ Доступ только для администраторов!",
+            reply_markup=MAIN_KEYBOARD
         )
         return ConversationHandler.END
 
+    handler = ADMIN_HANDLERS.get(update.message.text)
+    if handler is None:
+        return
+    return await handler(update, context)
+
 
 async def admin_add_points_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка добавления баллов админом"""
@@ -1222,7 +1735,7 @@ async def admin_add_points_handler(update: Update, context: ContextTypes.DEFAULT
     if text == "❌ Отмена":
         await update.message.reply_text(
             "❌ Добавление баллов отменено.",
-            reply_markup=get_admin_keyboard()
+            reply_markup=ADMIN_KEYBOARD
         )
         return ADMIN_MENU
 
@@ -1234,27 +1747,28 @@ async def admin_add_points_handler(update: Update, context: ContextTypes.DEFAULT
         user_id = int(parts[0])
         points = int(parts[1])
 
-        user_info = db.get_user_by_id(user_id)
+        user_info = await db_read(db.get_user_by_id, user_id)
         if not user_info:
             await update.message.reply_text(
                 f"❌ Пользователь с ID {user_id} не найден.",
-                reply_markup=get_cancel_keyboard()
+                reply_markup=CANCEL_KEYBOARD
             )
             return ADMIN_ADD_USER
 
-        if db.update_user_points(user_id, points, f"Изменение баланса администратором: {points:+d}"):
-            new_balance = user_info['current_points'] + points
+        new_balance = await db_write(db.update_user_points, user_id, points,
+                                     f"Изменение баланса администратором: {points:+d}")
+        if new_balance is not None:
             await update.message.reply_text(
-                f"✅ Пользователю *{user_info['name']}* {'добавлено' if points > 0 else 'списано'} {abs(points)} баллов\n"
+                f"✅ Пользователю *{escape_md(user_info['name'])}* {'добавлено' if points > 0 else 'списано'} {abs(points)} баллов\n"
                 f"💰 Новый баланс: {new_balance} баллов",
                 parse_mode='Markdown',
-                reply_markup=get_admin_keyboard()
+                reply_markup=ADMIN_KEYBOARD
             )
             return ADMIN_MENU
         else:
             await update.message.reply_text(
                 "❌ Ошибка при изменении баллов.",
-                reply_markup=get_admin_keyboard()
+                reply_markup=ADMIN_KEYBOARD
             )
             return ADMIN_MENU
 
@@ -1263,8 +1777,7 @@ async def admin_add_points_handler(update: Update, context: ContextTypes.DEFAULT
             "❌ Неверный формат. Введите: ID пользователя и количество баллов через пробел\n"
             "Пример: 1 500 (добавить 500 баллов)\n"
             "Пример: 1 -100 (убрать 100 баллов)",
-            parse_mode='Markdown',
-            reply_markup=get_cancel_keyboard()
+            reply_markup=CANCEL_KEYBOARD
         )
         return ADMIN_ADD_USER
 
@@ -1276,46 +1789,46 @@ async def admin_edit_user_handler(update: Update, context: ContextTypes.DEFAULT_
     if text == "❌ Отмена":
         await update.message.reply_text(
             "❌ Редактирование отменено.",
-            reply_markup=get_admin_keyboard()
+            reply_markup=ADMIN_KEYBOARD
         )
         return ADMIN_MENU
 
     try:
         user_id = int(text)
-        user_info = db.get_user_by_id(user_id)
+        user_info = await db_read(db.get_user_by_id, user_id)
 
         if not user_info:
             await update.message.reply_text(
                 f"❌ Пользователь с ID {user_id} не найден.",
-                reply_markup=get_cancel_keyboard()
+                reply_markup=CANCEL_KEYBOARD
             )
             return ADMIN_EDIT_USER
 
         await update.message.reply_text(
             f"✏️ *Редактирование пользователя:*\n\n"
-            f"👤 Имя: {user_info['name']}\n"
-            f"📱 Телефон: {user_info['phone']}\n"
-            f"⚤ Пол: {user_info.get('gender', 'Не указан')}\n"
+            f"👤 Имя: {escape_md(user_info['name'])}\n"
+            f"📱 Телефон: {escape_md(user_info['phone'])}\n"
+            f"⚤ Пол: {escape_md(user_info.get('gender', 'Не указан'))}\n"
             f"💰 Баланс: {user_info['current_points']} баллов\n"
             f"🛒 Покупок: {user_info['total_purchases']:.2f} руб.\n"
             f"📅 Регистрация: {user_info['registration_date']}\n"
             f"📱 QR код: {user_info.get('qr_code', 'Нет')}\n"
             f"🆔 Telegram ID: {user_info.get('telegram_id', 'Нет')}",
             parse_mode='Markdown',
-            reply_markup=get_admin_keyboard()
+            reply_markup=ADMIN_KEYBOARD
         )
 
         await update.message.reply_text(
             "Функция подробного редактирования в разработке.\n"
             "Используйте '➕ Добавить баллы' для изменения баланса.",
-            reply_markup=get_admin_keyboard()
+            reply_markup=ADMIN_KEYBOARD
         )
         return ADMIN_MENU
 
     except ValueError:
         await update.message.reply_text(
             "❌ Неверный формат. Введите ID пользователя (число):",
-            reply_markup=get_cancel_keyboard()
+            reply_markup=CANCEL_KEYBOARD
         )
         return ADMIN_EDIT_USER
 
@@ -1328,12 +1841,12 @@ async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if user.id in ADMINS:
         await update.message.reply_text(
             "❌ Действие отменено.",
-            reply_markup=get_admin_keyboard()
+            reply_markup=ADMIN_KEYBOARD
         )
     else:
         await update.message.reply_text(
             "❌ Действие отменено.",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     return ConversationHandler.END
 
@@ -1341,54 +1854,97 @@ async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ==================== ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ====================
 application = None
 
+# Пул соединений с Telegram API: размер и ожидание свободного соединения, секунд
+TELEGRAM_POOL_SIZE = 256
+TELEGRAM_POOL_TIMEOUT = 10
+
 
 # ==================== ОСНОВНАЯ ФУНКЦИЯ ЗАПУСКА ====================
+UVICORN_LOOP = "uvloop" if uvloop else "asyncio"
+
+
+async def run_bot_and_webhook(port: int = 8000):
+    """Polling бота и вебхук Эвотор в одном event loop"""
+    # Server.serve() работает в уже запущенном loop и не выбирает его сам:
+    # uvloop здесь включается через uvloop.install() в main() до asyncio.run
+    server = uvicorn.Server(uvicorn.Config(app, host="0.0.0.0", port=port))
+    async with application:
+        await application.start()
+        await application.updater.start_polling()
+        print(f"✅ Вебхук запущен: http://localhost:{port}")
+        try:
+            # Работает до Ctrl+C: сигналы обрабатывает uvicorn
+            await server.serve()
+        finally:
+            await application.updater.stop()
+            await application.stop()
+
+
 def main():
     """Запуск бота и вебхука"""
     global application
 
-    print("=" * 60)
-    print("🤖 СИСТЕМА ЛОЯЛЬНОСТИ ЭВОТОР")
-    print("=" * 60)
-    print(f"Python версия: {sys.version}")
-    print(f"Токен бота: {'Установлен' if BOT_TOKEN and BOT_TOKEN != '8200085604:AAHyzg31wBdNHDRFxvSWz_wNkFzp9iRRBD0' else 'ТЕСТОВЫЙ'}")
-    print(f"Папка: {BASE_DIR}")
-    print(f"База данных: {DB_NAME}")
-    print(f"WEBHOOK_URL: {WEBHOOK_URL}")
-    
+    # Баннер собираем целиком и выводим одной записью
+    lines = [
+        "=" * 60,
+        "🤖 СИСТЕМА ЛОЯЛЬНОСТИ ЭВОТОР",
+        "=" * 60,
+        f"Python версия: {sys.version}",
+        f"Токен бота: {'Установлен' if BOT_TOKEN and BOT_TOKEN != '8200085604:AAHyzg31wBdNHDRFxvSWz_wNkFzp9iRRBD0' else 'ТЕСТОВЫЙ'}",
+        f"Папка: {BASE_DIR}",
+        f"База данных: {DB_NAME}",
+        f"WEBHOOK_URL: {WEBHOOK_URL}",
+    ]
+
     # Проверяем существование requirements.txt
     req_file = os.path.join(BASE_DIR, 'requirements.txt')
     if os.path.exists(req_file):
-        print(f"✅ requirements.txt найден: {req_file}")
+        lines.append(f"✅ requirements.txt найден: {req_file}")
     else:
-        print(f"⚠️  requirements.txt не найден в: {req_file}")
-        print("Список файлов в папке:")
-        for file in os.listdir(BASE_DIR):
-            print(f"  - {file}")
+        lines.append(f"⚠️  requirements.txt не найден в: {req_file}")
+        lines.append("Список файлов в папке:")
+        lines.extend(f"  - {file}" for file in os.listdir(BASE_DIR))
 
     if BOT_TOKEN == "8200085604:AAHyzg31wBdNHDRFxvSWz_wNkFzp9iRRBD0":
-        print("⚠️  ВНИМАНИЕ: Используется тестовый токен!")
-        print("⚠️  Получите реальный токен у @BotFather")
-
-    print(f"🔑 Админ ID: {YOUR_TELEGRAM_ID}")
-    print(f"👑 Всего админов: {len(ADMINS)}")
-    print(f"💾 База данных: {DB_NAME}")
-    print(f"🎁 Бонус за регистрацию: {LOYALTY_SETTINGS['welcome_bonus']} баллов")
-    print(f"🌐 Сервер: {WEBHOOK_URL}")
-    print(f"📱 Вебхук: {WEBHOOK_URL}/evotor/webhook")
-    print(f"📊 Настройки: {LOYALTY_SETTINGS['points_per_purchase'] * 100}% баллов за рубль")
-    print("=" * 60)
+        lines.append("⚠️  ВНИМАНИЕ: Используется тестовый токен!")
+        lines.append("⚠️  Получите реальный токен у @BotFather")
+
+    lines += [
+        f"🔑 Админ ID: {YOUR_TELEGRAM_ID}",
+        f"👑 Всего админов: {len(ADMINS)}",
+        f"💾 База данных: {DB_NAME}",
+        f"🎁 Бонус за регистрацию: {WELCOME_BONUS} баллов",
+        f"🌐 Сервер: {WEBHOOK_URL}",
+        f"📱 Вебхук: {WEBHOOK_URL}/evotor/webhook",
+        f"📊 Настройки: {POINTS_PER_PURCHASE_PCT}% баллов за рубль",
+        "=" * 60,
+    ]
 
     # Проверяем базу данных
     try:
         stats = db.get_system_stats()
-        print(f"📊 Статистика: {stats['total_users']} пользователей, {stats['total_sales']:.2f} руб. оборот")
+        lines.append(f"📊 Статистика: {stats['total_users']} пользователей, {stats['total_sales']:.2f} руб. оборот")
     except Exception as e:
-        print(f"⚠️  Ошибка БД: {e}")
+        lines.append(f"⚠️  Ошибка БД: {e}")
+
+    sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
+
+    # Event loop на uvloop ставим до создания Application и запуска сервера
+    if uvloop:
+        uvloop.install()
 
     # Создаем Application для бота
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        # Один пул HTTP соединений бота используют и ответы в чатах, и уведомления
+        # из вебхука: соединения с Telegram переиспользуются, а не открываются заново
+        application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .connection_pool_size(TELEGRAM_POOL_SIZE)
+            .pool_timeout(TELEGRAM_POOL_TIMEOUT)
+            .build()
+        )
         print("✅ Telegram бот инициализирован")
     except Exception as e:
         print(f"❌ Ошибка инициализации бота: {e}")
@@ -1400,16 +1956,13 @@ def main():
         entry_points=[CommandHandler('start', start)],
         states={
             PHONE: [
-                MessageHandler(
-                    filters.CONTACT | filters.TEXT & ~filters.COMMAND,
-                    get_phone
-                )
+                MessageHandler(PHONE_FILTER, get_phone)
             ],
             NAME: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)
+                MessageHandler(TEXT_NO_CMD, get_name)
             ],
             GENDER: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, get_gender)
+                MessageHandler(TEXT_NO_CMD, get_gender)
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel_handler)],
@@ -1417,23 +1970,23 @@ def main():
 
     # Обработчик покупок и баллов
     purchase_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text(["➕ Добавить покупку"]), handle_buttons)],
+        entry_points=[MessageHandler(ADD_PURCHASE_FILTER, handle_buttons)],
         states={
             ADD_PURCHASE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, add_purchase_handler)
+                MessageHandler(TEXT_NO_CMD, add_purchase_handler)
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel_handler)],
     )
 
     points_conv_handler = ConversationHandler(
-        entry_points=[MessageHandler(filters.Text(["🎁 Использовать баллы"]), handle_buttons)],
+        entry_points=[MessageHandler(SPEND_POINTS_FILTER, handle_buttons)],
         states={
             SPEND_POINTS: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, spend_points_handler)
+                MessageHandler(TEXT_NO_CMD, spend_points_handler)
             ],
             CHECK_BALANCE: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, calculate_discount_handler)
+                MessageHandler(TEXT_NO_CMD, calculate_discount_handler)
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel_handler)],
@@ -1444,13 +1997,13 @@ def main():
         entry_points=[CommandHandler('admin', admin_panel)],
         states={
             ADMIN_MENU: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, handle_admin_buttons)
+                MessageHandler(TEXT_NO_CMD, handle_admin_buttons)
             ],
             ADMIN_ADD_USER: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_add_points_handler)
+                MessageHandler(TEXT_NO_CMD, admin_add_points_handler)
             ],
             ADMIN_EDIT_USER: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, admin_edit_user_handler)
+                MessageHandler(TEXT_NO_CMD, admin_edit_user_handler)
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel_handler)],
@@ -1462,8 +2015,11 @@ def main():
     application.add_handler(points_conv_handler)
     application.add_handler(admin_conv_handler)
 
+    # Страницы списка пользователей в админ панели
+    application.add_handler(CallbackQueryHandler(admin_users_page_callback, pattern=r'^users:\d+$'))
+
     # Обработчик кнопок (для остальных кнопок)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_buttons))
+    application.add_handler(MessageHandler(TEXT_NO_CMD, handle_buttons))
 
     # Команда помощи
     async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1475,7 +2031,7 @@ def main():
                 "/start - Перезапуск бота\n\n"
                 f"🌐 *Сервер:* {WEBHOOK_URL}",
                 parse_mode='Markdown',
-                reply_markup=get_admin_keyboard()
+                reply_markup=ADMIN_KEYBOARD
             )
         else:
             await update.message.reply_text(
@@ -1484,7 +2040,7 @@ def main():
                 "/help - Эта справка\n\n"
                 "Используйте кнопки для навигации",
                 parse_mode='Markdown',
-                reply_markup=get_main_keyboard()
+                reply_markup=MAIN_KEYBOARD
             )
 
     application.add_handler(CommandHandler('help', help_command))
@@ -1492,7 +2048,7 @@ def main():
     # Команда для проверки статуса
     async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
-        stats = db.get_system_stats()
+        stats = await get_system_stats()
 
         status_text = (
             f"📊 *Статус системы:*\n\n"
@@ -1506,43 +2062,23 @@ def main():
         await update.message.reply_text(
             status_text,
             parse_mode='Markdown',
-            reply_markup=get_admin_keyboard() if user.id in ADMINS else get_main_keyboard()
+            reply_markup=ADMIN_KEYBOARD if user.id in ADMINS else MAIN_KEYBOARD
         )
 
     application.add_handler(CommandHandler('status', status_command))
 
-    print("\n✅ Система готова к работе!")
-    print("\n📱 *Инструкция:*")
-    print("1. Откройте Telegram и найдите вашего бота")
-    print("2. Нажмите START или отправьте /start")
-    print("3. Следуйте инструкциям регистрации")
-    print("4. Получите QR код для кассы")
-    print("\n👑 *Админ панель:*")
-    print("• Отправьте команду /admin")
-    print("• Или используйте Telegram ID:", YOUR_TELEGRAM_ID)
-    print("\n🌐 *Интеграция с Эвотор:*")
-    print("1. URL вебхука:", f"{WEBHOOK_URL}/evotor/webhook")
-    print("2. Установите скрипт на терминал Эвотор")
-    print("3. Клиенты показывают QR код на кассе")
-    print("4. Баллы начисляются автоматически")
-    print("=" * 60)
+    print(STARTUP_INSTRUCTIONS)
 
     try:
         if IS_RENDER or 'PYTHONANYWHERE_DOMAIN' in os.environ:
             print("🌐 Cloud режим: Запуск FastAPI сервера...")
             # На Render запускаем uvicorn
             port = int(os.environ.get("PORT", 10000))
-            uvicorn.run(app, host="0.0.0.0", port=port)
+            uvicorn.run(app, host="0.0.0.0", port=port, loop=UVICORN_LOOP)
         else:
             print("🚀 Локальный запуск: Запуск бота в режиме polling...")
-            # Локально запускаем вебхук в отдельном потоке
-            webhook_thread = threading.Thread(
-                target=lambda: uvicorn.run(app, host="0.0.0.0", port=8000),
-                daemon=True
-            )
-            webhook_thread.start()
-            print("✅ Вебхук запущен: http://localhost:8000")
-            application.run_polling()
+            # Бот и вебхук работают в одном event loop, без отдельного потока
+            asyncio.run(run_bot_and_webhook())
     except Exception as e:
         print(f"❌ Ошибка запуска: {e}")
         print("Проверьте токен и подключение к интернету")